@@ -4,39 +4,9 @@ import shutil
 import sys
 from os.path import isdir
 
-from telemetry.telescope_devkit.asg import AsgCli
 from telemetry.telescope_devkit.cli import cli
 from telemetry.telescope_devkit.cli import get_console
-from telemetry.telescope_devkit.codebuild import CodebuildCli
-from telemetry.telescope_devkit.ec2 import Ec2Cli
-from telemetry.telescope_devkit.elasticsearch import ElasticsearchCli
-from telemetry.telescope_devkit.logs import LogsCli
-from telemetry.telescope_devkit.migration.cli import Phase1Cli
-from telemetry.telescope_devkit.migration.cli import Phase1MetricsCli
-from telemetry.telescope_devkit.migration.cli import Phase1SnapshotCli
-from telemetry.telescope_devkit.migration.cli import Phase2PostCutoverCli
-from telemetry.telescope_devkit.migration.cli import Phase2PreCutoverCli
-from telemetry.telescope_devkit.migration.cli import Phase3Cli
-from telemetry.telescope_devkit.msk import MskCli
-from telemetry.telescope_devkit.sts import StsCli
-
-commands = {
-    "asg": AsgCli,
-    "codebuild": CodebuildCli,
-    "ec2": Ec2Cli,
-    "elasticsearch": ElasticsearchCli,
-    "logs": LogsCli,
-    "migration": {
-        "phase-1": Phase1Cli,
-        "phase-1-metrics": Phase1MetricsCli,
-        "phase-1-snapshot": Phase1SnapshotCli,
-        "phase-2-pre-cutover": Phase2PreCutoverCli,
-        "phase-2-post-cutover": Phase2PostCutoverCli,
-        "phase-3": Phase3Cli,
-    },
-    "msk": MskCli,
-    "sts": StsCli,
-}
+from telemetry.telescope_devkit.commands import COMMANDS
 
 
 def is_running_in_docker() -> bool:
@@ -57,6 +27,22 @@ def is_running_in_docker() -> bool:
         return "docker" in ifh.read()
 
 
+def pop_profile_flag(argv: list) -> (bool, str or None):
+    """
+    Remove the global --profile flag from argv before Fire parses it. --profile=<file.json>
+    also writes the trace in Chrome trace event format.
+    """
+    for i, arg in enumerate(argv):
+        if arg == "--profile":
+            del argv[i]
+            return True, None
+        if arg.startswith("--profile="):
+            del argv[i]
+            return True, arg.split("=", 1)[1]
+
+    return False, None
+
+
 def setup_ssh_config():
     if not isdir("/root/.ssh"):
         shutil.copytree("/root/.ssh_host", "/root/.ssh")
@@ -66,7 +52,18 @@ if __name__ == "__main__":
     try:
         if is_running_in_docker():
             setup_ssh_config()
-        exit_code = cli(commands, name="telescope")
+        profile, trace_filename = pop_profile_flag(sys.argv)
+        if profile:
+            from telemetry.telescope_devkit.profiler import enable_profiling
+
+            profiler = enable_profiling()
+        try:
+            exit_code = cli(COMMANDS, name="telescope")
+        finally:
+            if profile:
+                profiler.print_waterfall(get_console(stderr=True))
+                if trace_filename:
+                    profiler.write_chrome_trace(trace_filename)
         if isinstance(exit_code, int):
             sys.exit(exit_code)
     except Exception as e:
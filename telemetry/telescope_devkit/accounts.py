@@ -0,0 +1,132 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from boto3.session import Session
+
+from telemetry.telescope_devkit.aws import get_session
+from telemetry.telescope_devkit.cli import get_console
+from telemetry.telescope_devkit.cli import get_full_class_name
+from telemetry.telescope_devkit.cli import print_rows
+from telemetry.telescope_devkit.filesystem import get_repo_path
+
+DEFAULT_PROFILE_TEMPLATE = "telemetry-{account_name}-RoleTelemetryEngineer"
+FAN_OUT_MAX_WORKERS = 8
+
+
+class AwsAccounts(object):
+    """Index of data/aws-accounts.json by account number and by account name."""
+
+    def __init__(self, accounts: dict):
+        self.numbers = dict(accounts)
+        self.names = {v: k for k, v in accounts.items()}
+        self.webops_pairs = {
+            name: name.replace("mdtp-", "webops-", 1)
+            for name in accounts
+            if name.startswith("mdtp-")
+            and name.replace("mdtp-", "webops-", 1) in accounts
+        }
+
+    def get_name(self, account: str) -> str:
+        return self.names[account]
+
+    def get_webops_pair(self, account_name: str) -> str or None:
+        return self.webops_pairs.get(account_name)
+
+
+@lru_cache(maxsize=None)
+def get_aws_accounts() -> AwsAccounts:
+    with open(os.path.join(get_repo_path(), "data/aws-accounts.json")) as json_file:
+        return AwsAccounts(json.load(json_file))
+
+
+def select_accounts(accounts=None, all_accounts: bool = False) -> List[str]:
+    """
+    Resolve the --accounts/--all_accounts options into a list of account names from
+    data/aws-accounts.json. Accounts can be given as a comma separated string or a list.
+    """
+    known_accounts = get_aws_accounts().numbers
+    if all_accounts:
+        return list(known_accounts)
+
+    if isinstance(accounts, str):
+        accounts = accounts.split(",")
+    account_names = [str(a).strip() for a in accounts or [] if str(a).strip()]
+    unknown = [a for a in account_names if a not in known_accounts]
+    if unknown:
+        raise ValueError(f"Unknown AWS accounts: {', '.join(unknown)}")
+
+    return account_names
+
+
+def fan_out(
+    fn: Callable[[Session], List[dict]],
+    account_names: List[str],
+    profile_template: str = DEFAULT_PROFILE_TEMPLATE,
+    max_workers: int = FAN_OUT_MAX_WORKERS,
+) -> Tuple[List[dict], Dict[str, Exception]]:
+    """
+    Call fn with a boto3 session for each account concurrently. Returns the rows of every
+    account, in the order the accounts were given and with an "account" key added, along with
+    the error raised by each account that failed. A failing account doesn't stop the others.
+    """
+
+    def run(account_name: str) -> List[dict]:
+        session = get_session(profile_template.format(account_name=account_name))
+        return [{"account": account_name, **row} for row in fn(session)]
+
+    rows = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            account_name: executor.submit(run, account_name)
+            for account_name in account_names
+        }
+        for account_name, future in futures.items():
+            try:
+                rows.extend(future.result())
+            except Exception as e:
+                errors[account_name] = e
+
+    return rows, errors
+
+
+def print_fan_out(
+    fn: Callable[[Session], List[dict]],
+    columns: dict,
+    accounts=None,
+    all_accounts: bool = False,
+    output: str = "table",
+    profile_template: str = DEFAULT_PROFILE_TEMPLATE,
+    max_workers: int = FAN_OUT_MAX_WORKERS,
+) -> None:
+    """
+    Run fn in every selected account and print the merged rows with an Account column. Exits
+    with status 1 if any account failed: returning it would make Fire print it after the rows.
+    """
+    # Progress and errors go to stderr so that json and csv output stay machine readable
+    stderr_console = get_console(stderr=True)
+    try:
+        account_names = select_accounts(accounts, all_accounts)
+    except ValueError as e:
+        stderr_console.print(f"[red]ERROR: {e}[/red]")
+        sys.exit(1)
+
+    with stderr_console.status(
+        f"[bold green]Querying {len(account_names)} accounts..."
+    ) as status:
+        rows, errors = fan_out(fn, account_names, profile_template, max_workers)
+
+    print_rows(get_console(), rows, {"account": "Account", **columns}, output)
+    for account_name, e in errors.items():
+        stderr_console.print(
+            f"[red]ERROR: {account_name}: {e} ({get_full_class_name(e)})[/red]"
+        )
+    if errors:
+        sys.exit(1)
@@ -1,47 +1,168 @@
-import boto3
+from collections import Counter
+from typing import Dict
+from typing import List
+
+from boto3.session import Session
 from rich.table import Table
 
+from telemetry.telescope_devkit.accounts import DEFAULT_PROFILE_TEMPLATE
+from telemetry.telescope_devkit.accounts import FAN_OUT_MAX_WORKERS
+from telemetry.telescope_devkit.accounts import print_fan_out
+from telemetry.telescope_devkit.aws import get_client
 from telemetry.telescope_devkit.cli import get_console
 
+TELEMETRY_ASG_COLUMNS = {
+    "name": "ASG Name",
+    "desired_capacity": "Desired Capacity",
+    "min_size": "Min Size",
+    "max_size": "Max Size",
+    "in_service": "InService",
+    "pending": "Pending",
+    "unhealthy": "Unhealthy",
+    "instance_types": "Instance Types",
+    "availability_zones": "AZ Spread",
+    "last_activity": "Last Scaling Activity",
+}
+TELEMETRY_ASG_FILTERS = [
+    {"Name": "tag:sensu-team-handler", "Values": ["team-telemetry"]},
+]
+# describe_scaling_activities returns the activities of every group in the region, most recent
+# first, so the number of pages read to find each group's latest activity is capped
+SCALING_ACTIVITIES_PAGE_SIZE = 100
+SCALING_ACTIVITIES_MAX_PAGES = 5
+SCALING_ACTIVITIES_MAX_ITEMS = (
+    SCALING_ACTIVITIES_PAGE_SIZE * SCALING_ACTIVITIES_MAX_PAGES
+)
+
 
 class Asg(object):
-    def __init__(self):
-        self.autoscaling_client = boto3.client("autoscaling", region_name="eu-west-2")
+    def __init__(self, session: Session = None):
+        self._session = session
 
-    def get_telemetry_asgs(self):
+    @property
+    def autoscaling_client(self):
+        return get_client("autoscaling", self._session)
+
+    def get_telemetry_asgs(self) -> List[dict]:
         paginator = self.autoscaling_client.get_paginator(
             "describe_auto_scaling_groups"
         )
-        page_iterator = paginator.paginate(PaginationConfig={"PageSize": 100})
+        page_iterator = paginator.paginate(
+            Filters=TELEMETRY_ASG_FILTERS, PaginationConfig={"PageSize": 100}
+        )
+
+        return [asg for page in page_iterator for asg in page["AutoScalingGroups"]]
+
+    def get_latest_scaling_activities(self, asg_names: List[str]) -> Dict[str, dict]:
+        """
+        Find the most recent scaling activity of each group by paging through the activities of
+        the whole region, rather than calling describe_scaling_activities once per group. Groups
+        without any activity in the latest SCALING_ACTIVITIES_MAX_ITEMS are left out.
+        """
+        activities = {}
+        paginator = self.autoscaling_client.get_paginator("describe_scaling_activities")
+        page_iterator = paginator.paginate(
+            PaginationConfig={
+                "PageSize": SCALING_ACTIVITIES_PAGE_SIZE,
+                "MaxItems": SCALING_ACTIVITIES_MAX_ITEMS,
+            }
+        )
+        for page in page_iterator:
+            for activity in page["Activities"]:
+                name = activity["AutoScalingGroupName"]
+                if name in asg_names and name not in activities:
+                    activities[name] = activity
+            if len(activities) == len(asg_names):
+                break
+
+        return activities
 
-        return page_iterator.search(
-            "AutoScalingGroups[] | [?contains(Tags[?Key==`sensu-team-handler`].Value, `team-telemetry`)]"
+    def get_telemetry_asg_rows(self) -> List[dict]:
+        asgs = self.get_telemetry_asgs()
+        activities = self.get_latest_scaling_activities(
+            [asg["AutoScalingGroupName"] for asg in asgs]
         )
 
+        return [
+            {
+                "name": asg["AutoScalingGroupName"],
+                "desired_capacity": str(asg["DesiredCapacity"]),
+                "min_size": str(asg["MinSize"]),
+                "max_size": str(asg["MaxSize"]),
+                **get_health_rollup(asg["Instances"]),
+                "last_activity": _format_activity(
+                    activities.get(asg["AutoScalingGroupName"])
+                ),
+            }
+            for asg in asgs
+        ]
+
+
+def get_health_rollup(instances: List[dict]) -> dict:
+    """Summarise the lifecycle state, health, type and AZ of the instances of a group."""
+    lifecycle_states = Counter(i["LifecycleState"] for i in instances)
+    instance_types = Counter(i.get("InstanceType", "-") for i in instances)
+    availability_zones = Counter(i["AvailabilityZone"] for i in instances)
+
+    return {
+        "in_service": str(lifecycle_states["InService"]),
+        "pending": str(
+            sum(
+                n
+                for state, n in lifecycle_states.items()
+                if state.startswith("Pending")
+            )
+        ),
+        "unhealthy": str(sum(1 for i in instances if i["HealthStatus"] != "Healthy")),
+        "instance_types": _format_counter(instance_types),
+        "availability_zones": _format_counter(availability_zones),
+    }
+
+
+def _format_counter(counter: Counter) -> str:
+    return ", ".join(f"{k} ×{n}" for k, n in sorted(counter.items())) or "-"
+
+
+def _format_activity(activity: dict = None) -> str:
+    if activity is None:
+        return f"none in last {SCALING_ACTIVITIES_MAX_ITEMS} activities"
+
+    return f"{activity['StartTime']:%Y-%m-%d %H:%M} {activity['StatusCode']}: {activity['Description']}"
+
 
 class AsgCli(object):
     def __init__(self):
         self._console = get_console()
         self._asg = Asg()
 
-    def all_telemetry(self):
+    def all_telemetry(
+        self,
+        accounts=None,
+        all_accounts: bool = False,
+        output: str = "table",
+        profile_template: str = DEFAULT_PROFILE_TEMPLATE,
+        max_workers: int = FAN_OUT_MAX_WORKERS,
+    ):
         """
-        Fetch details for all Telemetry ASGs running in a given environment
+        Fetch details for all Telemetry ASGs running in a given environment, or in every account
+        selected with --accounts=mdtp-qa,mdtp-staging or --all_accounts
         """
+        if accounts or all_accounts:
+            print_fan_out(
+                lambda session: Asg(session).get_telemetry_asg_rows(),
+                TELEMETRY_ASG_COLUMNS,
+                accounts,
+                all_accounts,
+                output,
+                profile_template,
+                max_workers,
+            )
+            return
+
         table = Table(show_header=True, header_style="bold green")
-        table.add_column("ASG Name")
-        table.add_column("Desired Capacity")
-        table.add_column("Min Size")
-        table.add_column("Max Size")
-        table.add_column("Instance Type")
-
-        for asg in self._asg.get_telemetry_asgs():
-            if asg["Instances"]:
-                table.add_row(
-                    asg["AutoScalingGroupName"],
-                    str(asg["DesiredCapacity"]),
-                    str(asg["MinSize"]),
-                    str(asg["MaxSize"]),
-                    asg["Instances"][0]["InstanceType"],
-                )
+        for column in TELEMETRY_ASG_COLUMNS.values():
+            table.add_column(column)
+
+        for row in self._asg.get_telemetry_asg_rows():
+            table.add_row(*[row[column] for column in TELEMETRY_ASG_COLUMNS])
         self._console.print(table)
@@ -0,0 +1,66 @@
+import threading
+
+import boto3
+from boto3.session import Session
+from botocore.config import Config
+
+from telemetry.telescope_devkit.profiler import get_profiler
+
+_sessions = {}
+_clients = {}
+_resources = {}
+_lock = threading.RLock()
+
+
+def get_session(profile_name: str = None) -> Session:
+    """
+    Return the session of the given AWS profile, creating it on first use. Without a profile
+    this is boto3's default session, so code still calling boto3.client() shares its credentials.
+    """
+    with _lock:
+        if profile_name is None:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            return boto3.DEFAULT_SESSION
+
+        if profile_name not in _sessions:
+            _sessions[profile_name] = Session(profile_name=profile_name)
+
+        return _sessions[profile_name]
+
+
+def get_client(
+    service_name: str,
+    session: Session = None,
+    region_name: str = None,
+    config: Config = None,
+):
+    """
+    Return the client of a service, created once per session, region and config. Creating a
+    client loads the service model from disk, and boto3 sessions aren't safe to create clients
+    from concurrently, so every caller should go through here rather than session.client().
+    """
+    session = session or get_session()
+    key = (session, service_name, region_name or session.region_name, config)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session.client(
+                service_name, region_name=region_name, config=config
+            )
+            if get_profiler() is not None:
+                get_profiler().instrument_client(_clients[key])
+
+        return _clients[key]
+
+
+def get_resource(service_name: str, session: Session = None, region_name: str = None):
+    """Return the resource of a service, created once per session and region."""
+    session = session or get_session()
+    key = (session, service_name, region_name or session.region_name)
+    with _lock:
+        if key not in _resources:
+            _resources[key] = session.resource(service_name, region_name=region_name)
+            if get_profiler() is not None:
+                get_profiler().instrument_client(_resources[key].meta.client)
+
+        return _resources[key]
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+import time
+from contextlib import suppress
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".aws", "telescope-devkit", "cache")
+
+
+def is_disk_cache_enabled() -> bool:
+    return os.getenv("TELESCOPE_DEVKIT_DISK_CACHE", "False").lower() in (
+        "true",
+        "1",
+        "t",
+        "y",
+        "yes",
+    )
+
+
+def get_cache_dir(namespace: str) -> str:
+    """
+    The default location lives under ~/.aws because that directory is bind-mounted into the
+    telescope-devkit container, so cached entries survive between container runs.
+    """
+    cache_dir = os.path.join(
+        os.path.expanduser(os.getenv("TELESCOPE_DEVKIT_CACHE_DIR", DEFAULT_CACHE_DIR)),
+        namespace,
+    )
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
+def get_cache_key(*parts) -> str:
+    return hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()
+
+
+def load_json_cache(namespace: str, key: str) -> dict or None:
+    filename = os.path.join(get_cache_dir(namespace), f"{key}.json")
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with open(filename) as json_file:
+            entry = json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+    if entry.get("expires_at", 0) <= time.time():
+        with suppress(OSError):
+            os.remove(filename)
+        return None
+
+    return entry["data"]
+
+
+def save_json_cache(namespace: str, key: str, data, expires_at: float) -> None:
+    filename = os.path.join(get_cache_dir(namespace), f"{key}.json")
+    with open(filename, "w") as json_file:
+        json.dump({"expires_at": expires_at, "data": data}, json_file)
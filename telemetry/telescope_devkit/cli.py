@@ -1,6 +1,14 @@
+import csv
+import json
+import re
+import sys
+from datetime import datetime
+from datetime import timedelta
+
 import fire
-from rich.console import Console
-from rich.markdown import Markdown
+
+# Rich is imported where it's used rather than here: this module is loaded at startup by
+# bin/telescope.py and shouldn't slow down commands (or --help) that don't print with Rich.
 
 
 def get_full_class_name(obj: object) -> str:
@@ -21,8 +29,10 @@ def cli(target, name):
     return fire.Fire(target, name=name)
 
 
-def get_console():
-    console = Console()
+def get_console(stderr: bool = False):
+    from rich.console import Console
+
+    console = Console(stderr=stderr)
 
     return console
 
@@ -32,6 +42,52 @@ def print_exception(e: Exception) -> None:
 
 
 def print_markdown(content):
+    from rich.console import Console
+    from rich.markdown import Markdown
+
     console = Console()
     markdown = Markdown(content)
     console.print(markdown)
+
+
+def print_rows(console, rows: list, columns: dict, output: str = "table") -> None:
+    """
+    Print a list of dict rows as a Rich table, as JSON (one object per line) or as CSV.
+    `columns` maps each row key to its table header and sets the column order.
+    """
+    if output == "json":
+        sys.stdout.writelines(
+            json.dumps({k: row.get(k) for k in columns}) + "\n" for row in rows
+        )
+    elif output == "csv":
+        writer = csv.DictWriter(
+            sys.stdout, fieldnames=list(columns), extrasaction="ignore"
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        from rich.table import Table
+
+        table = Table(show_header=True, header_style="bold green")
+        for header in columns.values():
+            table.add_column(header)
+        for row in rows:
+            table.add_row(*[str(row.get(k, "")) for k in columns])
+        console.print(table)
+
+
+def parse_time(value) -> int:
+    """
+    Convert a time given as epoch milliseconds, an ISO 8601 date/time or a relative duration
+    such as "30m", "12h" or "7d" (meaning that long ago) into epoch milliseconds.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+
+    match = re.fullmatch(r"(\d+)([smhdw])", str(value).strip())
+    if match:
+        unit = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+        delta = timedelta(**{unit[match.group(2)]: int(match.group(1))})
+        return int((datetime.now() - delta).timestamp() * 1000)
+
+    return int(datetime.fromisoformat(str(value)).timestamp() * 1000)
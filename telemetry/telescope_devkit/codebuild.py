@@ -1,20 +1,24 @@
-import boto3
 from boto3.session import Session
 
+from telemetry.telescope_devkit.aws import get_client
 from telemetry.telescope_devkit.cli import get_console
 
 
 class Codebuild(object):
-    def __init__(self):
-        self._client = boto3.client("codebuild")
+    def __init__(self, session: Session = None):
+        self._session = session
+
+    @property
+    def _client(self):
+        return get_client("codebuild", self._session)
 
     def get_latest_terraform_build_id(self, project_name: str, session: Session) -> str:
-        codebuild_session = session.client("codebuild")
+        codebuild_session = get_client("codebuild", session)
         builds = codebuild_session.list_builds_for_project(projectName=project_name)
         return builds["ids"][0]
 
     def get_terraform_build_status(self, project_id: str, session: Session) -> str:
-        codebuild_session = session.client("codebuild")
+        codebuild_session = get_client("codebuild", session)
         builds = codebuild_session.batch_get_builds(ids=[project_id])
         return builds["builds"][0]["buildStatus"]
 
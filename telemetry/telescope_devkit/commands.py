@@ -0,0 +1,76 @@
+import importlib
+
+# Keep this module free of heavy imports: it is loaded before Fire parses the command line.
+
+
+def lazy_command(path: str, summary: str):
+    """
+    Return a Fire command that imports "module:attribute" only when it is invoked. Fire calls
+    the returned function and carries on parsing the command line against the class it
+    returns, while help listings only need the summary.
+    """
+    module_name, attribute = path.split(":")
+
+    def load():
+        return getattr(importlib.import_module(module_name), attribute)
+
+    load.__name__ = attribute
+    load.__doc__ = summary
+
+    return load
+
+
+COMMANDS = {
+    "asg": lazy_command(
+        "telemetry.telescope_devkit.asg:AsgCli", "Telemetry AutoScaling groups"
+    ),
+    "codebuild": lazy_command(
+        "telemetry.telescope_devkit.codebuild:CodebuildCli",
+        "Start CodeBuild deployment projects",
+    ),
+    "ec2": lazy_command(
+        "telemetry.telescope_devkit.ec2:Ec2Cli",
+        "List, connect and tunnel to EC2 instances",
+    ),
+    "elasticsearch": lazy_command(
+        "telemetry.telescope_devkit.elasticsearch:ElasticsearchCli",
+        "Elasticsearch tooling such as elasticsearch-comrade",
+    ),
+    "logs": lazy_command(
+        "telemetry.telescope_devkit.logs:LogsCli", "Export and follow CloudWatch logs"
+    ),
+    "migration": {
+        "phase-1": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:Phase1Cli", "Phase 1 checklist"
+        ),
+        "phase-1-metrics": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:Phase1MetricsCli",
+            "Phase 1 Metrics checklist",
+        ),
+        "phase-1-snapshot": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:Phase1SnapshotCli",
+            "Phase 1 Snapshot Generation",
+        ),
+        "phase-2-pre-cutover": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:Phase2PreCutoverCli",
+            "Phase 2 pre-cutover checklist",
+        ),
+        "phase-2-post-cutover": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:Phase2PostCutoverCli",
+            "Phase 2 post-cutover checklist",
+        ),
+        "phase-3": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:Phase3Cli", "Phase 3 checklist"
+        ),
+        "run": lazy_command(
+            "telemetry.telescope_devkit.migration.cli:run",
+            "Run the checklists of several phases at once",
+        ),
+    },
+    "msk": lazy_command(
+        "telemetry.telescope_devkit.msk:MskCli", "Describe the MSK cluster"
+    ),
+    "sts": lazy_command(
+        "telemetry.telescope_devkit.sts:StsCli", "Show the current AWS caller identity"
+    ),
+}
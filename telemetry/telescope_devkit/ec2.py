@@ -1,34 +1,265 @@
+import csv
+import json
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fnmatch import fnmatchcase
+from typing import Iterator
+from typing import List
 from typing import Union
 
-import boto3
+from boto3.session import Session
+from mypy_boto3_ec2.service_resource import EC2ServiceResource
 from mypy_boto3_ec2.service_resource import Instance
-from mypy_boto3_ec2.service_resource import ServiceResourceInstancesCollection
+from rich.live import Live
+from rich.markup import escape
 from rich.table import Table
 
+from telemetry.telescope_devkit.accounts import DEFAULT_PROFILE_TEMPLATE
+from telemetry.telescope_devkit.accounts import FAN_OUT_MAX_WORKERS
+from telemetry.telescope_devkit.accounts import print_fan_out
+from telemetry.telescope_devkit.aws import get_resource
+from telemetry.telescope_devkit.aws import get_session
+from telemetry.telescope_devkit.cache import get_cache_key
+from telemetry.telescope_devkit.cache import is_disk_cache_enabled
+from telemetry.telescope_devkit.cache import load_json_cache
+from telemetry.telescope_devkit.cache import save_json_cache
 from telemetry.telescope_devkit.cli import get_console
-from telemetry.telescope_devkit.ssh import LocalPortForwarding
+from telemetry.telescope_devkit.ssh import parse_forwards
 from telemetry.telescope_devkit.ssh import ssh_to
+from telemetry.telescope_devkit.ssh import start_tunnel_session
+from telemetry.telescope_devkit.ssh import stream_remote
+from telemetry.telescope_devkit.ssh import TUNNEL_READY_TIMEOUT
+from telemetry.telescope_devkit.ssh import TunnelSession
+from telemetry.telescope_devkit.sts import get_caller_identity
+
+INVENTORY_TTL = 300  # seconds
+INSTANCE_COLUMNS = {
+    "name": "Instance Name",
+    "instance_id": "Instance Id",
+    "instance_type": "Instance Type",
+    "availability_zone": "Availability Zone",
+    "launch_time": "Launch Time",
+    "private_ip_address": "Private IP Address",
+}
+OUTPUT_FORMATS = ("table", "json", "csv")
+EXEC_MAX_PARALLEL = 10
+EXEC_TIMEOUT = 60  # seconds
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+class Ec2Inventory(object):
+    """
+    Snapshot of the running instances in one account and region, taken with a single paginated
+    DescribeInstances call and indexed by Name tag and by instance id. The snapshot is taken
+    again once it is older than the TTL. With TELESCOPE_DEVKIT_DISK_CACHE enabled it is also
+    persisted to disk and reused by later runs until it expires.
+    """
+
+    def __init__(
+        self,
+        ec2_resource: EC2ServiceResource,
+        cache_key: str = None,
+        ttl: int = INVENTORY_TTL,
+    ):
+        self._ec2_resource = ec2_resource
+        self._cache_key = cache_key
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._expires_at = 0
+        self._is_invalidated = False
+        self._instances = []
+        self._by_id = {}
+        self._by_name = {}
+
+    def refresh(self) -> None:
+        instances = []
+        paginator = self._ec2_resource.meta.client.get_paginator("describe_instances")
+        for page in paginator.paginate(
+            Filters=[{"Name": "instance-state-name", "Values": ["running"]}]
+        ):
+            for reservation in page["Reservations"]:
+                instances.extend(reservation["Instances"])
+
+        self._index(instances, time.time() + self.ttl)
+        self._is_invalidated = False
+        if self._cache_key and is_disk_cache_enabled():
+            save_json_cache(
+                "ec2-inventory",
+                self._cache_key,
+                {"expiresAt": self._expires_at, "instances": _encode(instances)},
+                self._expires_at,
+            )
+
+    def get_instances_by_name(
+        self, name: str, enable_wildcard: bool = True
+    ) -> List[Instance]:
+        """Name matching follows the EC2 tag filters, "*" and "?" are wildcards."""
+        self._ensure_fresh()
+        if enable_wildcard:
+            name = "*" + name + "*"
+
+        if any(c in name for c in "*?"):
+            instances = [
+                i for i in self._instances if fnmatchcase(_get_name_tag(i), name)
+            ]
+        else:
+            instances = self._by_name.get(name, [])
+
+        return [self._to_resource(i) for i in instances]
+
+    def get_instance_by_id(self, instance_id: str) -> Union[Instance, None]:
+        self._ensure_fresh()
+        if instance_id in self._by_id:
+            return self._to_resource(self._by_id[instance_id])
+
+    def invalidate(self) -> None:
+        """Take a new snapshot on next use instead of reusing this one or the one on disk."""
+        with self._lock:
+            self._expires_at = 0
+            self._is_invalidated = True
+
+    def _ensure_fresh(self) -> None:
+        with self._lock:
+            if time.time() < self._expires_at:
+                return
+
+            if self._cache_key and is_disk_cache_enabled() and not self._is_invalidated:
+                data = load_json_cache("ec2-inventory", self._cache_key)
+                if data is not None:
+                    self._index(_decode(data["instances"]), data["expiresAt"])
+                    return
+
+            self.refresh()
+
+    def _index(self, instances: List[dict], expires_at: float) -> None:
+        by_name = {}
+        for instance in instances:
+            by_name.setdefault(_get_name_tag(instance), []).append(instance)
+
+        self._instances = instances
+        self._by_id = {i["InstanceId"]: i for i in instances}
+        self._by_name = by_name
+        self._expires_at = expires_at
+
+    def _to_resource(self, data: dict) -> Instance:
+        # Resources built from already loaded data don't make any API call on attribute access
+        instance = self._ec2_resource.Instance(data["InstanceId"])
+        instance.meta.data = data
+
+        return instance
+
+
+def _get_name_tag(instance: dict) -> str:
+    for tag in instance.get("Tags", []):
+        if tag["Key"] == "Name":
+            return tag["Value"]
+
+    return ""
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if "$datetime" in value:
+            return datetime.fromisoformat(value["$datetime"])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+
+    return value
+
+
+def get_ec2_inventory(session: Session = None) -> Ec2Inventory:
+    """Return the shared inventory of the account and region the session points to."""
+    session = session or get_session()
+    account = get_caller_identity(session)["Account"]
+    key = (account, session.region_name)
+    with _inventories_lock:
+        if key not in _inventories:
+            _inventories[key] = Ec2Inventory(
+                get_resource("ec2", session), cache_key=get_cache_key(*key)
+            )
+
+        return _inventories[key]
+
+
+def invalidate_ec2_inventories() -> None:
+    """Make every shared inventory take a new snapshot the next time it is used."""
+    with _inventories_lock:
+        inventories = list(_inventories.values())
+    for inventory in inventories:
+        inventory.invalidate()
 
 
 class Ec2(object):
-    def __init__(self, session=boto3):
+    def __init__(self, session: Session = None):
         """
         See https://boto3.amazonaws.com/v1/documentation/api/1.17.74/reference/services/ec2.html#EC2.ServiceResource.instances
         """
-        self._ec2_resource_service_client = session.resource("ec2")
+        self._session = session
+
+    @property
+    def _ec2_resource_service_client(self):
+        return get_resource("ec2", self._session)
+
+    @property
+    def inventory(self) -> Ec2Inventory:
+        return get_ec2_inventory(self._session)
 
     def get_instances_by_name(
         self, name: str, enable_wildcard: bool = True
-    ) -> ServiceResourceInstancesCollection:
+    ) -> List[Instance]:
+        return self.inventory.get_instances_by_name(name, enable_wildcard)
+
+    def iter_instance_rows(
+        self, name: str, enable_wildcard: bool = True
+    ) -> Iterator[List[dict]]:
+        """
+        Yield pages of running instances matching the name filter, projected down to the
+        INSTANCE_COLUMNS fields. Uses a single paginated client-level DescribeInstances call
+        and never builds resource objects, so rows can be rendered as each page arrives.
+        """
         if enable_wildcard:
             name = "*" + name + "*"
 
-        return self._ec2_resource_service_client.instances.filter(
+        paginator = self._ec2_resource_service_client.meta.client.get_paginator(
+            "describe_instances"
+        )
+        for page in paginator.paginate(
             Filters=[
                 {"Name": "tag:Name", "Values": [name]},
                 {"Name": "instance-state-name", "Values": ["running"]},
+            ],
+            PaginationConfig={"PageSize": 1000},
+        ):
+            yield [
+                {
+                    "name": _get_name_tag(instance),
+                    "instance_id": instance["InstanceId"],
+                    "instance_type": instance["InstanceType"],
+                    "availability_zone": instance["Placement"]["AvailabilityZone"],
+                    "launch_time": instance["LaunchTime"].strftime("%Y-%m-%d %H:%M:%S"),
+                    "private_ip_address": instance.get("PrivateIpAddress"),
+                }
+                for reservation in page["Reservations"]
+                for instance in reservation["Instances"]
             ]
-        )
 
     def get_instance_by_name(
         self, name: str, enable_wildcard: bool = True
@@ -56,10 +287,55 @@ class Ec2Cli(object):
         self._console = get_console()
         self._ec2 = Ec2()
 
-    def instances(self, name: str, enable_wildcard: bool = True) -> None:
-        with self._console.status("[bold green]Fetching instances info...") as status:
-            instances = self._ec2.get_instances_by_name(name, enable_wildcard)
-            self._render_instances(instances)
+    def instances(
+        self,
+        name: str,
+        enable_wildcard: bool = True,
+        output: str = "table",
+        accounts=None,
+        all_accounts: bool = False,
+        profile_template: str = DEFAULT_PROFILE_TEMPLATE,
+        max_workers: int = FAN_OUT_MAX_WORKERS,
+    ) -> None:
+        """
+        List the running EC2 instances matching a name. Use --output=json (one object per line)
+        or --output=csv to stream plain rows without laying out a table.
+        With --accounts=mdtp-qa,mdtp-staging or --all_accounts the instances of every selected
+        account are listed together, using the AWS profile named by --profile_template.
+        """
+        if output not in OUTPUT_FORMATS:
+            self._console.print(
+                f"[red]ERROR: Unsupported output '{output}', expected one of {OUTPUT_FORMATS}[/red]"
+            )
+            sys.exit(1)
+
+        if accounts or all_accounts:
+            print_fan_out(
+                lambda session: [
+                    row
+                    for rows in Ec2(session).iter_instance_rows(name, enable_wildcard)
+                    for row in rows
+                ],
+                INSTANCE_COLUMNS,
+                accounts,
+                all_accounts,
+                output,
+                profile_template,
+                max_workers,
+            )
+            return
+
+        pages = self._ec2.iter_instance_rows(name, enable_wildcard)
+        if output == "json":
+            for rows in pages:
+                sys.stdout.writelines(json.dumps(row) + "\n" for row in rows)
+        elif output == "csv":
+            writer = csv.DictWriter(sys.stdout, fieldnames=list(INSTANCE_COLUMNS))
+            writer.writeheader()
+            for rows in pages:
+                writer.writerows(rows)
+        else:
+            self._render_instances(pages)
 
     def ssh(self, instance_name: str, enable_wildcard: bool = True) -> int:
         """SSH to the first EC2 instances that matches the name filter given."""
@@ -78,9 +354,95 @@ class Ec2Cli(object):
         self._console.print(f"[bold green]Connecting to {ip_address}...")
         return ssh_to(ip_address)
 
+    def exec(
+        self,
+        instance_name: str,
+        command: str,
+        enable_wildcard: bool = True,
+        max_parallel: int = EXEC_MAX_PARALLEL,
+        timeout: int = EXEC_TIMEOUT,
+    ) -> None:
+        """
+        Run a command over SSH on every EC2 instance that matches the name filter given, at most
+        --max_parallel hosts at a time and for up to --timeout seconds per host. Output lines
+        are prefixed with the host they came from and a summary of exit codes is printed last.
+        """
+        with self._console.status("[bold green]Fetching instances info...") as status:
+            instances = self._ec2.get_instances_by_name(instance_name, enable_wildcard)
+
+        if not instances:
+            self._console.print(
+                f"[red]ERROR: No '{instance_name}' instances found in this account[/red]"
+            )
+            sys.exit(1)
+
+        def run(instance: Instance) -> str:
+            ip_address = instance.private_ip_address
+            try:
+                returncode = stream_remote(
+                    ip_address,
+                    command,
+                    lambda line: self._console.print(
+                        f"[cyan]{ip_address}[/cyan] | {escape(line.rstrip())}"
+                    ),
+                    timeout,
+                )
+            except subprocess.TimeoutExpired:
+                return "timeout"
+            except OSError as e:
+                return f"error: {e}"
+
+            return str(returncode)
+
+        self._console.print(
+            f"[bold green]Running '{escape(command)}' on {len(instances)} instances..."
+        )
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            results = list(executor.map(run, instances))
+
+        table = Table(show_header=True, header_style="bold green")
+        table.add_column("Instance Name")
+        table.add_column("Instance Id")
+        table.add_column("Private IP Address")
+        table.add_column("Exit Code")
+        for instance, result in zip(instances, results):
+            table.add_row(
+                _get_name_tag(instance.meta.data),
+                instance.instance_id,
+                instance.private_ip_address,
+                f"[green]{result}[/green]" if result == "0" else f"[red]{result}[/red]",
+            )
+        self._console.print(table)
+        if any(result != "0" for result in results):
+            sys.exit(1)
+
     def tunnel(
-        self, instance_name: str, host: str, port: int, local_host: str = "0.0.0.0"
+        self,
+        instance_name: str,
+        host: str = None,
+        port: int = None,
+        local_host: str = "0.0.0.0",
+        forwards=None,
+        ready_timeout: int = TUNNEL_READY_TIMEOUT,
     ) -> int:
+        """
+        Forward local ports to services reachable from an EC2 instance. Several services can be
+        forwarded in one session with --forwards=elasticsearch:9200,clickhouse:8123,grafana:3000
+        (or local_port:host:port), all over a single SSH connection to the instance.
+        """
+        try:
+            tunnel_forwards = parse_forwards(forwards)
+        except ValueError as e:
+            self._console.print(f"[red]ERROR: {e}[/red]")
+            return 1
+        if host is not None and port is not None:
+            tunnel_forwards.insert(0, (host, int(port), int(port)))
+        if not tunnel_forwards:
+            self._console.print(
+                "[red]ERROR: Give a host and port or --forwards to set up[/red]"
+            )
+            return 1
+
         with self._console.status(
             "[bold green]Fetching instance IP address..."
         ) as status:
@@ -95,67 +457,40 @@ class Ec2Cli(object):
             return 1
 
         ssh_server_ip_address = instance.private_ip_address
-
-        with self._console.status(
-            f"[bold green]Setting up an SSH tunnel to {host}:{port} via {ssh_server_ip_address}... "
-        ) as status:
-            tunnel = LocalPortForwarding(
-                ssh_server_ip_address,
-                destination_host=host,
-                destination_port=port,
-                local_host=local_host,
-            )
-            tunnel.start()
-
-        if not tunnel.is_service_reachable():
-            self._console.print(
-                f"Unable to reach remote service via {local_host}:{port}"
-            )
-            tunnel.stop()
+        session = TunnelSession(ssh_server_ip_address, tunnel_forwards, local_host)
+        if not start_tunnel_session(self._console, session, ready_timeout):
             return 1
 
-        if host != local_host:
-            self._console.print(
-                f"If you need to access this service via {host} instead of {local_host} make sure to "
-                f"add an entry in the /etc/hosts file"
-            )
+        for forward in session.forwards:
+            if forward.destination_host != local_host:
+                self._console.print(
+                    f"If you need to access this service via {forward.destination_host} instead of "
+                    f"{local_host} make sure to add an entry in the /etc/hosts file"
+                )
 
         self._console.input(
             "\nPress [yellow]<Enter>[/yellow] at any time to stop the SSH tunnel... "
         )
 
-        with self._console.print(
-            f"[bold green]Stopping SSH tunnel to {host}:{port} via {ssh_server_ip_address}..."
+        with self._console.status(
+            f"[bold green]Stopping SSH tunnel via {ssh_server_ip_address}..."
         ) as status:
-            tunnel.stop()
+            session.stop()
 
         return 0
 
-    def _render_instances(self, instances: ServiceResourceInstancesCollection):
-        if len(list(instances)) <= 0:
+    def _render_instances(self, pages: Iterator[List[dict]]):
+        table = Table(show_header=True, header_style="bold green")
+        for column in INSTANCE_COLUMNS.values():
+            table.add_column(column)
+
+        with Live(table, console=self._console, auto_refresh=False) as live:
+            for rows in pages:
+                for row in rows:
+                    table.add_row(*[row[column] for column in INSTANCE_COLUMNS])
+                live.refresh()
+
+        if table.row_count <= 0:
             self._console.print(
                 "[bright_yellow]⚠ There are no EC2 instances running in this account.[/bright_yellow]"
             )
-            return
-
-        table = Table(show_header=True, header_style="bold green")
-        table.add_column("Instance Name")
-        table.add_column("Instance Id")
-        table.add_column("Instance Type")
-        table.add_column("Availability Zone")
-        table.add_column("Launch Time")
-        table.add_column("Private IP Address")
-        for instance in instances:
-            # See https://boto3.amazonaws.com/v1/documentation/api/1.17.74/reference/services/ec2.html#EC2.ServiceResource.Instance
-            instance_name = [
-                tag["Value"] for tag in instance.tags if tag["Key"] == "Name"
-            ][0]
-            table.add_row(
-                instance_name,
-                instance.instance_id,
-                instance.instance_type,
-                instance.placement["AvailabilityZone"],
-                instance.launch_time.strftime("%Y-%m-%d %H:%M:%S"),
-                instance.private_ip_address,
-            )
-        self._console.print(table)
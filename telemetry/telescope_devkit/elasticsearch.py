@@ -1,11 +1,15 @@
 import json
 import os
+import sys
 
 from telemetry.telescope_devkit.cli import get_console
 from telemetry.telescope_devkit.docker import DockerClient
 from telemetry.telescope_devkit.ec2 import Ec2
 from telemetry.telescope_devkit.filesystem import get_repo_path
-from telemetry.telescope_devkit.ssh import LocalPortForwarding
+from telemetry.telescope_devkit.ssh import parse_forwards
+from telemetry.telescope_devkit.ssh import start_tunnel_session
+from telemetry.telescope_devkit.ssh import TUNNEL_READY_TIMEOUT
+from telemetry.telescope_devkit.ssh import TunnelSession
 from telemetry.telescope_devkit.sts import Sts
 
 
@@ -14,7 +18,7 @@ class Comrade(object):
         self._console = get_console()
         self._ec2 = Ec2()
         self._sts = Sts()
-        self._docker = DockerClient()
+        self._docker_client = None
         self._clusters_data_dir = os.path.join(
             get_repo_path(), "data/elasticsearch-comrade"
         )
@@ -24,7 +28,19 @@ class Comrade(object):
 
         self._use_docker_py = False
 
-    def run(self):
+    @property
+    def _docker(self) -> DockerClient:
+        if self._docker_client is None:
+            self._docker_client = DockerClient()
+        return self._docker_client
+
+    def run(self, forwards=None, ready_timeout: int = TUNNEL_READY_TIMEOUT) -> None:
+        try:
+            tunnel_forwards = parse_forwards(forwards)
+        except ValueError as e:
+            self._console.print(f"[red]ERROR: {e}[/red]")
+            sys.exit(1)
+
         instance_name = "elasticsearch-master"
         instance = self._ec2.get_instance_by_name(instance_name, enable_wildcard=False)
 
@@ -32,19 +48,14 @@ class Comrade(object):
             self._console.print(
                 f"[red]ERROR: No '{instance_name}' instances found in this account[/red]"
             )
-            return 1
+            sys.exit(1)
 
         ssh_server_ip_address = instance.private_ip_address
-        with self._console.status(
-            f"[bold green]Setting up an SSH tunnel to elasticsearch:9200 via {ssh_server_ip_address}... "
-        ) as status:
-            tunnel = LocalPortForwarding(ssh_server_ip_address, "elasticsearch", 9200)
-            tunnel.start()
-
-        if not tunnel.is_service_reachable():
-            self._console.print(f"Unable to reach remote service via localhost:9200")
-            tunnel.stop()
-            return 1
+        tunnel = TunnelSession(
+            ssh_server_ip_address, [("elasticsearch", 9200, 9200)] + tunnel_forwards
+        )
+        if not start_tunnel_session(self._console, tunnel, ready_timeout):
+            sys.exit(1)
 
         self._generate_cluster_config()
         self._console.print(
@@ -88,7 +99,7 @@ class Comrade(object):
             self._console.print(f"Created directory '{self._clusters_data_dir}'")
 
         with self._console.status(
-            f"[bold green]Stopping SSH tunnel to elasticsearch:9200 via {ssh_server_ip_address}..."
+            f"[bold green]Stopping SSH tunnel via {ssh_server_ip_address}..."
         ) as status:
             tunnel.stop()
 
@@ -108,10 +119,9 @@ class Comrade(object):
 
 
 class ElasticsearchCli(object):
-    def __init__(self):
-        self._comrade = Comrade()
-        # print('init')
-
-    def comrade(self):
-        self._comrade.run()
-        # print('run')
+    def comrade(self, forwards=None, ready_timeout: int = TUNNEL_READY_TIMEOUT) -> None:
+        """
+        Launch elasticsearch-comrade through an SSH tunnel to elasticsearch:9200. Additional
+        services can be forwarded in the same session, e.g. --forwards=clickhouse:8123,grafana:3000
+        """
+        Comrade().run(forwards, ready_timeout)
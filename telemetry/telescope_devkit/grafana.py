@@ -1,9 +1,45 @@
+import threading
 import time
+from typing import Dict
 from typing import List
+from typing import Tuple
+from typing import Union
+from urllib.parse import urlencode
 
-import boto3
 import requests
 
+from telemetry.telescope_devkit.aws import get_client
+
+DEFAULT_SSM_PATH = "/telemetry/secrets/grafana/migration_api_key"
+
+_clients = {}
+_clients_lock = threading.Lock()
+_client_locks = {}
+_datasource_ids = {}
+_datasource_ids_lock = threading.Lock()
+_datasource_id_locks = {}
+
+
+class RenderQuery(object):
+    """
+    A named Graphite target. The time window is optional, queries that don't set one are
+    rendered over the window given to Grafana.render().
+    """
+
+    def __init__(
+        self,
+        name: str,
+        target: str,
+        from_time: str = None,
+        until: str = None,
+        max_data_points: int = None,
+    ):
+        self.name = name
+        self.target = target
+        self.from_time = from_time
+        self.until = until
+        self.max_data_points = max_data_points
+
 
 class Grafana:
     def __init__(
@@ -11,7 +47,7 @@ class Grafana:
         hostname: str = "localhost",
         port: int = 443,
         scheme: str = "https",
-        ssm_path: str = "/telemetry/secrets/grafana/migration_api_key",
+        ssm_path: str = DEFAULT_SSM_PATH,
     ):
         api_key = self._get_api_key(ssm_path)
         self.default_headers = {
@@ -19,41 +55,56 @@ class Grafana:
             "Accept": "application/json",
         }
         self.base_url = f"{scheme}://{hostname}:{port}"
+        self._session = requests.Session()
+        self._session.headers.update(self.default_headers)
 
-    def has_metric(self, metric_path: str) -> bool:
-        datasource_id = self._get_datasource_id("carbonapi-clickhouse")
-
-        url = f"{self.base_url}/api/datasources/proxy/{datasource_id}/metrics/find"
-        headers = self.default_headers
-        headers["Content-Type"] = "application/x-www-form-urlencoded"
-        data = f"query={metric_path}"
+    def has_metric(self, metric_path: str, deadline: float = 10) -> bool:
+        has_metric = self.has_metrics([metric_path], deadline)[metric_path]
 
-        has_metric = False
-        timeout = 10  # seconds
-
-        while timeout >= 0:
-            response = requests.post(url, data=data, headers=headers)
+        if has_metric:
+            print(f"✅ Metric '{metric_path}' was found in Grafana.")
+        else:
+            print(f"❌ Metric '{metric_path}' not found in Grafana.")
 
-            if response.status_code != 200:
-                raise Exception(
-                    f"ERROR! has_metric received unexpected response code {response.status_code}, response: {response.content}, url: {url}, data: {data}"
-                )
+        return has_metric
 
-            json = response.json()
-            has_metric = json and json[0]["id"] == metric_path
+    def has_metrics(
+        self,
+        metric_paths: List[str],
+        deadline: float = 10,
+        initial_delay: float = 0.25,
+        max_delay: float = 2,
+    ) -> Dict[str, bool]:
+        """
+        Poll /metrics/find until every metric path (or glob) has been found or the deadline, in
+        seconds, has passed. Polling backs off exponentially between attempts and returns as soon
+        as the last metric shows up. Exact paths that share a parent node are looked up with a
+        single brace expression query, so N metrics cost far fewer than N requests per attempt.
+        """
+        found = {metric_path: False for metric_path in metric_paths}
+        pending = list(found)
+        deadline_at = time.monotonic() + deadline
+        delay = initial_delay
 
-            timeout -= 1
-            time.sleep(1)
+        while True:
+            for query, query_paths in _group_find_queries(pending):
+                metric_ids = self._find_metrics(query)
+                for metric_path in query_paths:
+                    found[metric_path] = (
+                        len(metric_ids) > 0
+                        if _is_glob(metric_path)
+                        else metric_path in metric_ids
+                    )
 
-            if has_metric:
+            pending = [metric_path for metric_path in pending if not found[metric_path]]
+            remaining = deadline_at - time.monotonic()
+            if not pending or remaining <= 0:
                 break
 
-        if has_metric:
-            print(f"✅ Metric '{metric_path}' was found in Grafana.")
-        else:
-            print(f"❌ Metric '{metric_path}' not found in Grafana.")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
 
-        return has_metric
+        return found
 
     def get_metric_value(self, metric_query: str) -> List:
         datasource_id = self._get_datasource_id("carbonapi-clickhouse")
@@ -61,11 +112,10 @@ class Grafana:
         url = (
             f"{self.base_url}/api/datasources/proxy/{datasource_id}/render?format=json"
         )
-        headers = self.default_headers
-        headers["Content-Type"] = "application/x-www-form-urlencoded"
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
         data = f"target={metric_query}"
 
-        response = requests.post(url, data=data, headers=headers)
+        response = self._session.post(url, data=data, headers=headers)
 
         if response.status_code != 200:
             raise Exception(
@@ -74,22 +124,159 @@ class Grafana:
 
         return response.json()
 
-    def _get_datasource_id(self, name: str) -> int:
-        url = f"{self.base_url}/api/datasources/name/{name}"
-        headers = self.default_headers
-        headers["Content-Type"] = "application/json"
-        response = requests.get(url, headers=headers)
+    def render(
+        self,
+        queries: List[Union[RenderQuery, str]],
+        from_time: str = "-15min",
+        until: str = "now",
+        max_data_points: int = None,
+    ) -> Dict[str, List]:
+        """
+        Render many targets with as few /render requests as possible: one per distinct time
+        window. Results are keyed by query name, or by the target itself for plain strings, and
+        hold the list of series that target returned.
+        """
+        datasource_id = self._get_datasource_id("carbonapi-clickhouse")
+
+        url = (
+            f"{self.base_url}/api/datasources/proxy/{datasource_id}/render?format=json"
+        )
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        windows = {}
+        for query in queries:
+            if not isinstance(query, RenderQuery):
+                query = RenderQuery(name=query, target=query)
+            window = (
+                query.from_time or from_time,
+                query.until or until,
+                query.max_data_points or max_data_points,
+            )
+            windows.setdefault(window, []).append(query)
+
+        results = {}
+        for (
+            window_from,
+            window_until,
+            window_max_data_points,
+        ), batch in windows.items():
+            params = [
+                # Prefix every series with the index of the query that produced it, as Graphite
+                # doesn't otherwise say which target a series in the response belongs to.
+                ("target", f"aliasSub({query.target},'^(.*)$','{i}|\\1')")
+                for i, query in enumerate(batch)
+            ]
+            params += [("from", window_from), ("until", window_until)]
+            if window_max_data_points is not None:
+                params.append(("maxDataPoints", window_max_data_points))
+
+            response = self._session.post(url, data=urlencode(params), headers=headers)
+
+            if response.status_code != 200:
+                raise Exception(
+                    f"ERROR! render received unexpected response code {response.status_code}, response: {response.content}"
+                )
+
+            for query in batch:
+                results[query.name] = []
+            for series in response.json():
+                index, target = series["target"].split("|", 1)
+                series["target"] = target
+                results[batch[int(index)].name].append(series)
+
+        return results
+
+    def _find_metrics(self, query: str) -> List[str]:
+        datasource_id = self._get_datasource_id("carbonapi-clickhouse")
+
+        url = f"{self.base_url}/api/datasources/proxy/{datasource_id}/metrics/find"
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        data = urlencode({"query": query})
+
+        response = self._session.post(url, data=data, headers=headers)
 
         if response.status_code != 200:
             raise Exception(
-                f"ERROR! _get_datasource_id received unexpected response code {response.status_code}, response: {response.content}"
+                f"ERROR! _find_metrics received unexpected response code {response.status_code}, response: {response.content}, url: {url}, data: {data}"
             )
 
-        return response.json()["id"]
+        return [node["id"] for node in response.json() or []]
+
+    def _get_datasource_id(self, name: str) -> int:
+        """Datasource ids are looked up once per Grafana host and shared by all its clients."""
+        key = (self.base_url, name)
+        # Lookups against different hosts run concurrently, each behind its own lock
+        with _datasource_ids_lock:
+            datasource_id_lock = _datasource_id_locks.setdefault(key, threading.Lock())
+        with datasource_id_lock:
+            if key in _datasource_ids:
+                return _datasource_ids[key]
+
+            url = f"{self.base_url}/api/datasources/name/{name}"
+            headers = {"Content-Type": "application/json"}
+            response = self._session.get(url, headers=headers)
+
+            if response.status_code != 200:
+                raise Exception(
+                    f"ERROR! _get_datasource_id received unexpected response code {response.status_code}, response: {response.content}"
+                )
+
+            _datasource_ids[key] = response.json()["id"]
+
+            return _datasource_ids[key]
 
     def _get_api_key(self, ssm_path: str) -> str:
-        ssm = boto3.client("ssm")
+        ssm = get_client("ssm")
         parameter = ssm.get_parameter(Name=ssm_path, WithDecryption=True)
         api_key = parameter["Parameter"]["Value"]
 
         return api_key
+
+
+def _is_glob(metric_path: str) -> bool:
+    return any(c in metric_path for c in "*?[{")
+
+
+def _group_find_queries(metric_paths: List[str]) -> List[Tuple[str, List[str]]]:
+    """Group exact metric paths by parent node into "parent.{a,b}" queries, globs go on their own."""
+    queries = []
+    siblings = {}
+    for metric_path in metric_paths:
+        if _is_glob(metric_path) or "." not in metric_path:
+            queries.append((metric_path, [metric_path]))
+        else:
+            parent, leaf = metric_path.rsplit(".", 1)
+            siblings.setdefault(parent, []).append(metric_path)
+
+    for parent, paths in siblings.items():
+        if len(paths) == 1:
+            queries.append((paths[0], paths))
+        else:
+            leaves = ",".join(path.rsplit(".", 1)[1] for path in paths)
+            queries.append((f"{parent}.{{{leaves}}}", paths))
+
+    return queries
+
+
+def get_grafana(
+    hostname: str = "localhost",
+    port: int = 443,
+    scheme: str = "https",
+    ssm_path: str = DEFAULT_SSM_PATH,
+) -> Grafana:
+    """
+    Return the Grafana client registered for this host and API key, creating it on first use.
+    Clients keep a keep-alive HTTP session, so reusing them saves the SSM lookup for the API key
+    as well as a TLS handshake per request.
+    """
+    key = (scheme, hostname, port, ssm_path)
+    # Clients of different hosts are created concurrently, each behind its own lock
+    with _clients_lock:
+        client_lock = _client_locks.setdefault(key, threading.Lock())
+    with client_lock:
+        if key not in _clients:
+            _clients[key] = Grafana(
+                hostname=hostname, port=port, scheme=scheme, ssm_path=ssm_path
+            )
+
+        return _clients[key]
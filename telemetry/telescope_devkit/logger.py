@@ -1,10 +1,16 @@
 import logging
+import logging.handlers
 import os
 import sys
+import threading
+from typing import List
 
 from telemetry.telescope_devkit import APP_NAME
 from telemetry.telescope_devkit.filesystem import get_repo_path
 
+# Held while a buffer is replayed, so that buffers flushed concurrently don't interleave
+_flush_lock = threading.Lock()
+
 
 def create_app_logger(level: str = logging.DEBUG):
     level = level.upper() if isinstance(level, str) else level
@@ -45,3 +51,50 @@ def create_file_logger(name: str, filename: str, level: str = logging.DEBUG):
 
 def get_file_logger(name: str):
     return logging.getLogger(name)
+
+
+class BufferingLogHandler(logging.handlers.BufferingHandler):
+    """Holds log records in memory until flush() hands them to the target logger."""
+
+    def __init__(self, target: logging.Logger):
+        super().__init__(capacity=0)
+        self.target = target
+
+    def shouldFlush(self, record: logging.LogRecord) -> bool:
+        return False
+
+    def flush(self) -> None:
+        with _flush_lock:
+            self.acquire()
+            try:
+                for record in self.buffer:
+                    self.target.handle(record)
+                self.buffer.clear()
+            finally:
+                self.release()
+
+
+def create_buffered_logger(name: str, target: logging.Logger):
+    logger = logging.getLogger(name)
+    logger.setLevel(target.level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(BufferingLogHandler(target))
+
+    return logger
+
+
+def get_buffered_messages(logger: logging.Logger) -> List[str]:
+    """The messages held by a buffered logger that haven't been flushed yet."""
+    return [
+        record.getMessage()
+        for handler in logger.handlers
+        if isinstance(handler, BufferingLogHandler)
+        for record in handler.buffer
+    ]
+
+
+def flush_buffered_logger(logger: logging.Logger) -> None:
+    for handler in logger.handlers:
+        handler.flush()
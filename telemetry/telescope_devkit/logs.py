@@ -1,16 +1,42 @@
+import gzip
+import json
+import os
+import sys
 import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Iterator
+from typing import List
+from typing import Tuple
 
-import boto3
+from botocore.config import Config
 from mypy_boto3_logs import CloudWatchLogsClient
 from rich.errors import MarkupError
+from rich.markup import escape
 
+from telemetry.telescope_devkit.aws import get_client
+from telemetry.telescope_devkit.cache import get_cache_dir
+from telemetry.telescope_devkit.cache import get_cache_key
 from telemetry.telescope_devkit.cli import get_console
+from telemetry.telescope_devkit.cli import parse_time
 from telemetry.telescope_devkit.logger import get_app_logger
 
 logger = get_app_logger()
 console = get_console()
 
+EXPORT_BUFFER_SIZE = 1024 * 1024  # bytes
+EXPORT_FORMATS = ("text", "jsonl")
+# FilterLogEvents is throttled at a handful of requests per second per account and region, so
+# downloads use few workers and let botocore's adaptive retry mode pace them.
+DOWNLOAD_MAX_WORKERS = 4
+DOWNLOAD_CLIENT_CONFIG = Config(retries={"mode": "adaptive", "max_attempts": 10})
+FOLLOW_POLL_INTERVAL = 5  # seconds
+# Log groups can have thousands of streams, more than the open file limit
+MERGE_MAX_OPEN_FILES = 256
+
 
 def _get_latest_log_stream(logs_client: CloudWatchLogsClient, group_name: str) -> dict:
     stream_response = logs_client.describe_log_streams(
@@ -19,8 +45,165 @@ def _get_latest_log_stream(logs_client: CloudWatchLogsClient, group_name: str) -
     return stream_response["logStreams"].pop()
 
 
+def iter_log_event_pages(
+    logs_client: CloudWatchLogsClient,
+    group_name: str,
+    log_stream_name: str,
+    start_time: int = None,
+    end_time: int = None,
+    next_token: str = None,
+) -> Iterator[dict]:
+    """
+    Yield get_log_events pages from the head of a log stream. CloudWatch always returns a
+    nextForwardToken, the end of the stream is reached when it comes back unchanged.
+    """
+    kwargs = {
+        "logGroupName": group_name,
+        "logStreamName": log_stream_name,
+        "startFromHead": True,
+    }
+    if end_time is not None:
+        kwargs["endTime"] = end_time
+    if next_token is not None:
+        kwargs["nextToken"] = next_token
+    elif start_time is not None:
+        kwargs["startTime"] = start_time
+
+    while True:
+        page = logs_client.get_log_events(**kwargs)
+        yield page
+
+        if page["nextForwardToken"] == kwargs.get("nextToken"):
+            return
+        kwargs["nextToken"] = page["nextForwardToken"]
+
+
+class LogExportWriter(object):
+    """
+    Buffers log events and appends them to the export file in large writes. With compression
+    enabled every flushed buffer is written as its own gzip member, so the file stays a valid
+    gzip stream and can be truncated back to any flushed offset when an export is resumed.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        output_format: str = "text",
+        compress: bool = False,
+        offset: int = 0,
+        buffer_size: int = EXPORT_BUFFER_SIZE,
+    ):
+        if output_format not in EXPORT_FORMATS:
+            raise ValueError(
+                f"Unsupported output format '{output_format}', expected one of {EXPORT_FORMATS}"
+            )
+        self.filename = filename
+        self.output_format = output_format
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered_bytes = 0
+
+        if os.path.isfile(filename):
+            os.truncate(filename, offset)
+        self._file = open(filename, "ab")
+
+    @property
+    def is_full(self) -> bool:
+        return self._buffered_bytes >= self.buffer_size
+
+    def write(self, event: dict) -> None:
+        if self.output_format == "jsonl":
+            line = json.dumps(event) + "\n"
+        else:
+            line = event["message"]
+        data = line.encode("utf-8")
+        self._buffer.append(data)
+        self._buffered_bytes += len(data)
+
+    def flush(self) -> int:
+        """Write out the buffered events and return the resulting file offset."""
+        if self._buffer:
+            data = b"".join(self._buffer)
+            self._file.write(gzip.compress(data) if self.compress else data)
+            self._file.flush()
+            self._buffer = []
+            self._buffered_bytes = 0
+
+        return self._file.tell()
+
+    def close(self) -> None:
+        self.flush()
+        self._file.close()
+
+
+class LogExportCheckpoint(object):
+    """Records how far an export got, so an interrupted export resumes where it stopped."""
+
+    def __init__(self, export_filename: str, log_stream_name: str):
+        self.export_filename = export_filename
+        self.filename = f"{export_filename}.checkpoint"
+        self.log_stream_name = log_stream_name
+        self.next_token = None
+        self.offset = 0
+
+    def load(self) -> bool:
+        if not os.path.isfile(self.filename):
+            return False
+
+        with open(self.filename) as json_file:
+            data = json.load(json_file)
+        if data.get("logStreamName") != self.log_stream_name:
+            return False
+        if (
+            not os.path.isfile(self.export_filename)
+            or os.path.getsize(self.export_filename) < data["offset"]
+        ):
+            return False
+        self.next_token = data["nextToken"]
+        self.offset = data["offset"]
+
+        return True
+
+    def save(self, next_token: str, offset: int) -> None:
+        self.next_token = next_token
+        self.offset = offset
+        with open(self.filename, "w") as json_file:
+            json.dump(
+                {
+                    "logStreamName": self.log_stream_name,
+                    "nextToken": next_token,
+                    "offset": offset,
+                },
+                json_file,
+            )
+
+    def clear(self) -> None:
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+def get_export_filename(
+    group_name: str, log_stream_name: str, output_format: str, compress: bool
+) -> str:
+    extension = "jsonl" if output_format == "jsonl" else "log"
+    if compress:
+        extension += ".gz"
+
+    return (
+        tempfile.gettempdir()
+        + "/"
+        + f"{group_name}_{log_stream_name}.{extension}".replace("/", "-").strip("-")
+    )
+
+
 def get_latest_cloudwatch_logs(
-    logs_client: CloudWatchLogsClient, group_name: str, print_to_screen: bool = False
+    logs_client: CloudWatchLogsClient,
+    group_name: str,
+    print_to_screen: bool = False,
+    output_format: str = "text",
+    compress: bool = False,
+    resume: bool = True,
 ) -> None:
 
     console.print(f"Fetching CloudWatch logs for log-group {group_name}")
@@ -35,60 +218,378 @@ def get_latest_cloudwatch_logs(
         + f"last event time is {last_event_datetime}"
     )
 
-    export_filename = (
-        tempfile.gettempdir()
-        + "/"
-        + f"{group_name}_{log_stream_name}.log".replace("/", "-").strip("-")
+    export_filename = get_export_filename(
+        group_name, log_stream_name, output_format, compress
+    )
+    checkpoint = LogExportCheckpoint(export_filename, log_stream_name)
+    if resume and checkpoint.load():
+        console.print(
+            f"Resuming export to '[yellow]{export_filename}[/yellow]' from byte {checkpoint.offset}"
+        )
+    else:
+        checkpoint.clear()
+        console.print(f"Saving log events to '[yellow]{export_filename}[/yellow]'")
+    writer = LogExportWriter(
+        export_filename, output_format, compress, offset=checkpoint.offset
     )
-    console.print(f"Saving log events to '[yellow]{export_filename}[/yellow]'")
-    file = open(export_filename, "w")
 
     try:
-        log_events = logs_client.get_log_events(
-            logGroupName=group_name,
-            logStreamName=latest_log_stream["logStreamName"],
-            startTime=latest_log_stream["firstEventTimestamp"],
-            endTime=latest_log_stream["lastEventTimestamp"],
-            startFromHead=True,
+        pages = iter_log_event_pages(
+            logs_client,
+            group_name,
+            log_stream_name,
+            start_time=first_event_timestamp,
+            end_time=last_event_timestamp,
+            next_token=checkpoint.next_token,
         )
-        if print_to_screen:
-            logger.info(f"Displaying {len(log_events['events'])} log events")
-        for event in log_events["events"]:
+        for page_number, log_events in enumerate(pages):
             if print_to_screen:
-                console.print(event["message"], end="")
-            file.write(event["message"])
-
-        while "nextForwardToken" in log_events:
-            log_events = logs_client.get_log_events(
-                logGroupName=group_name,
-                logStreamName=latest_log_stream["logStreamName"],
-                endTime=latest_log_stream["lastEventTimestamp"],
-                nextToken=log_events["nextForwardToken"],
-                startFromHead=True,
-            )
-            if print_to_screen:
-                input(
-                    "Press Enter to display the next %s log events "
-                    % len(log_events["events"])
-                )
+                if page_number == 0:
+                    logger.info(f"Displaying {len(log_events['events'])} log events")
+                else:
+                    input(
+                        "Press Enter to display the next %s log events "
+                        % len(log_events["events"])
+                    )
             for event in log_events["events"]:
-                try:
-                    if print_to_screen:
+                if print_to_screen:
+                    try:
                         console.print(event["message"], end="")
-                    file.write(event["message"])
-                except MarkupError:
-                    print(event["message"])
+                    except MarkupError:
+                        print(event["message"])
+                writer.write(event)
+
+            if writer.is_full:
+                checkpoint.save(log_events["nextForwardToken"], writer.flush())
+        writer.close()
+        checkpoint.clear()
     except Exception as e:
         logger.error(e)
+        writer.close()
+
+
+def split_time_range(
+    start_time: int, end_time: int, slice_minutes: int
+) -> List[Tuple[int, int]]:
+    slice_length = int(slice_minutes * 60 * 1000)
+    return [
+        (slice_start, min(slice_start + slice_length, end_time))
+        for slice_start in range(start_time, end_time, slice_length)
+    ]
+
+
+def _download_time_slice(
+    logs_client: CloudWatchLogsClient,
+    group_name: str,
+    start_time: int,
+    end_time: int,
+    slice_filename: str,
+) -> int:
+    events = []
+    paginator = logs_client.get_paginator("filter_log_events")
+    # endTime is inclusive in FilterLogEvents, slices are half-open so they don't overlap
+    for page in paginator.paginate(
+        logGroupName=group_name, startTime=start_time, endTime=end_time - 1
+    ):
+        events.extend(page["events"])
+    events.sort(key=lambda e: (e["timestamp"], e["logStreamName"], e["eventId"]))
+
+    with open(slice_filename, "w") as file:
+        file.writelines(json.dumps(event) + "\n" for event in events)
+
+    return len(events)
+
+
+def _merge_time_slices(slice_filenames: List[str], output_dir: str) -> int:
+    """
+    Slices cover consecutive time ranges and are each sorted by timestamp, so concatenating them
+    in order gives a time-ordered view of the whole log group. At most MERGE_MAX_OPEN_FILES
+    stream files are kept open, the least recently written one is closed to open another.
+    """
+    streams_dir = os.path.join(output_dir, "streams")
+    os.makedirs(streams_dir, exist_ok=True)
+    stream_files = OrderedDict()
+    seen_streams = set()
+    count = 0
+    try:
+        with open(os.path.join(output_dir, "merged.log"), "w") as merged_file:
+            for slice_filename in slice_filenames:
+                with open(slice_filename) as slice_file:
+                    for line in slice_file:
+                        event = json.loads(line)
+                        stream_name = event["logStreamName"]
+                        timestamp = datetime.fromtimestamp(event["timestamp"] / 1000)
+                        merged_file.write(
+                            f"[{timestamp.isoformat()}] [{stream_name}] {event['message']}"
+                        )
+                        stream_file = stream_files.pop(stream_name, None)
+                        if stream_file is None:
+                            if len(stream_files) >= MERGE_MAX_OPEN_FILES:
+                                stream_files.popitem(last=False)[1].close()
+                            stream_file = open(
+                                os.path.join(
+                                    streams_dir,
+                                    f"{stream_name}.log".replace("/", "-").strip("-"),
+                                ),
+                                "a" if stream_name in seen_streams else "w",
+                            )
+                            seen_streams.add(stream_name)
+                        stream_files[stream_name] = stream_file
+                        stream_file.write(event["message"])
+                        count += 1
+                os.remove(slice_filename)
     finally:
-        file.close()
+        for stream_file in stream_files.values():
+            stream_file.close()
+
+    return count
+
+
+def download_cloudwatch_log_group(
+    logs_client: CloudWatchLogsClient,
+    group_name: str,
+    start_time: int,
+    end_time: int,
+    output_dir: str,
+    slice_minutes: int = 60,
+    max_workers: int = DOWNLOAD_MAX_WORKERS,
+) -> int:
+    """
+    Download every event of a log group between two epoch millisecond timestamps by splitting
+    the range into slices fetched concurrently with filter_log_events. Events are written to a
+    file per log stream plus a merged, time-ordered merged.log. Returns the number of slices
+    that could not be downloaded.
+    """
+    slices = split_time_range(start_time, end_time, slice_minutes)
+    slices_dir = os.path.join(output_dir, "slices")
+    os.makedirs(slices_dir, exist_ok=True)
+    slice_filenames = [
+        os.path.join(slices_dir, f"{slice_start}-{slice_end}.jsonl")
+        for slice_start, slice_end in slices
+    ]
+
+    failed = 0
+    with console.status(
+        f"[bold green]Downloading {len(slices)} time slices of {group_name}..."
+    ) as status:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    _download_time_slice,
+                    logs_client,
+                    group_name,
+                    slice_start,
+                    slice_end,
+                    slice_filename,
+                ): (slice_start, slice_end)
+                for (slice_start, slice_end), slice_filename in zip(
+                    slices, slice_filenames
+                )
+            }
+            for done, future in enumerate(as_completed(futures), start=1):
+                slice_start, slice_end = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    console.print(
+                        f"[red]ERROR: Unable to download events between "
+                        f"{datetime.fromtimestamp(slice_start / 1000)} and "
+                        f"{datetime.fromtimestamp(slice_end / 1000)}: {e}[/red]"
+                    )
+                status.update(
+                    f"[bold green]Downloaded {done}/{len(slices)} time slices of {group_name}..."
+                )
+
+        count = _merge_time_slices(
+            [f for f in slice_filenames if os.path.isfile(f)], output_dir
+        )
+    os.rmdir(slices_dir)
+    console.print(
+        f"Saved {count} log events to '[yellow]{output_dir}[/yellow]' (merged.log and streams/)"
+    )
+
+    return failed
+
+
+class LogTailState(object):
+    """
+    Position of a live tail: the timestamp of the last event printed and the ids of the events
+    seen at that timestamp, since FilterLogEvents' startTime is inclusive.
+    """
+
+    def __init__(self, group_name: str):
+        self.group_name = group_name
+        self.filename = os.path.join(
+            get_cache_dir("logs-tail"), f"{get_cache_key(group_name)}.json"
+        )
+        self.timestamp = None
+        self.event_ids = []
+
+    def load(self) -> bool:
+        if not os.path.isfile(self.filename):
+            return False
+
+        with open(self.filename) as json_file:
+            data = json.load(json_file)
+        self.timestamp = data["timestamp"]
+        self.event_ids = data["eventIds"]
+
+        return True
+
+    def save(self) -> None:
+        with open(self.filename, "w") as json_file:
+            json.dump(
+                {"timestamp": self.timestamp, "eventIds": self.event_ids}, json_file
+            )
+
+    def clear(self) -> None:
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+    def start_at_latest_stream(self, logs_client: CloudWatchLogsClient) -> dict:
+        """
+        Move to the first event of the most recent log stream and return that stream. A stream
+        without events yet has no firstEventTimestamp, the tail then starts at its creation.
+        """
+        log_stream = _get_latest_log_stream(logs_client, self.group_name)
+        self.timestamp = log_stream.get(
+            "firstEventTimestamp", log_stream["creationTime"]
+        )
+        self.event_ids = []
+
+        return log_stream
+
+    def advance(self, events: List[dict]) -> None:
+        for event in events:
+            if event["timestamp"] != self.timestamp:
+                self.timestamp = event["timestamp"]
+                self.event_ids = []
+            self.event_ids.append(event["eventId"])
+
+
+def follow_cloudwatch_log_group(
+    logs_client: CloudWatchLogsClient,
+    group_name: str,
+    state: LogTailState,
+    poll_interval: int = FOLLOW_POLL_INTERVAL,
+) -> None:
+    """
+    Print new events of a log group as they arrive, across every log stream including the ones
+    created after the tail started. Only events newer than the saved position are requested on
+    each poll and the position is saved after every poll, so a restarted tail carries on from
+    where the last one stopped. Runs until interrupted.
+    """
+    paginator = logs_client.get_paginator("filter_log_events")
+    try:
+        while True:
+            events = []
+            for page in paginator.paginate(
+                logGroupName=group_name, startTime=state.timestamp
+            ):
+                events.extend(
+                    e for e in page["events"] if e["eventId"] not in state.event_ids
+                )
+            events.sort(key=lambda e: (e["timestamp"], e["eventId"]))
+
+            for event in events:
+                stream_name = event["logStreamName"].split("/")[-1]
+                console.print(
+                    f"[cyan]{escape(stream_name)}[/cyan] {escape(event['message'])}",
+                    end="",
+                )
+
+            if events:
+                state.advance(events)
+                state.save()
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
 
 
 class LogsCli(object):
-    def __init__(self):
-        self.logs_client = boto3.client("logs")
+    @property
+    def logs_client(self):
+        return get_client("logs")
+
+    def codebuild(
+        self,
+        project_name: str,
+        print_to_screen: bool = False,
+        output_format: str = "text",
+        compress: bool = False,
+        resume: bool = True,
+        follow: bool = False,
+        poll_interval: int = FOLLOW_POLL_INTERVAL,
+    ) -> None:
+        """
+        Export the latest CodeBuild log stream for a project. Use --output_format=jsonl to keep
+        the event timestamps and --compress to gzip the export. An interrupted export resumes
+        from its last checkpoint unless --noresume is given.
+        With --follow, new events of every stream in the project's log group are printed as they
+        arrive instead, continuing from the position where the previous tail stopped unless
+        --noresume is given.
+        """
+        if follow:
+            self._follow(f"/aws/codebuild/{project_name}", resume, poll_interval)
+            return
 
-    def codebuild(self, project_name: str, print_to_screen: bool = False) -> None:
         get_latest_cloudwatch_logs(
-            self.logs_client, f"/aws/codebuild/{project_name}", print_to_screen
+            self.logs_client,
+            f"/aws/codebuild/{project_name}",
+            print_to_screen,
+            output_format,
+            compress,
+            resume,
+        )
+
+    def _follow(self, group_name: str, resume: bool, poll_interval: int) -> None:
+        state = LogTailState(group_name)
+        if resume and state.load():
+            console.print(
+                f"Following {group_name} from {datetime.fromtimestamp(state.timestamp / 1000)}"
+            )
+        else:
+            state.clear()
+            latest_log_stream = state.start_at_latest_stream(self.logs_client)
+            console.print(
+                f"Following {group_name} from the start of '{latest_log_stream['logStreamName']}'"
+            )
+        console.print("Press [yellow]<ctrl-c>[/yellow] to stop.")
+
+        follow_cloudwatch_log_group(self.logs_client, group_name, state, poll_interval)
+
+    def download(
+        self,
+        group_name: str,
+        since: str = "1d",
+        until: str = None,
+        slice_minutes: int = 60,
+        max_workers: int = DOWNLOAD_MAX_WORKERS,
+        output_dir: str = None,
+    ) -> None:
+        """
+        Download a whole log group over a time range, e.g. a week of Terraform CodeBuild runs:
+        telescope logs download /aws/codebuild/<project> --since=7d
+        Times are ISO 8601, epoch milliseconds or durations ago such as 12h or 7d.
+        """
+        start_time = parse_time(since)
+        end_time = parse_time(until) if until is not None else parse_time("0s")
+        if output_dir is None:
+            output_dir = os.path.join(
+                tempfile.gettempdir(),
+                f"{group_name}_{start_time}-{end_time}".replace("/", "-").strip("-"),
+            )
+        logs_client = get_client("logs", config=DOWNLOAD_CLIENT_CONFIG)
+
+        failed = download_cloudwatch_log_group(
+            logs_client,
+            group_name,
+            start_time,
+            end_time,
+            output_dir,
+            slice_minutes,
+            max_workers,
         )
+        if failed:
+            sys.exit(1)
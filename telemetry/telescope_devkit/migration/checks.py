@@ -3,29 +3,40 @@ import json
 import re
 import shlex
 import subprocess
+import time
+from concurrent.futures import Future
 from json.decoder import JSONDecodeError
 from subprocess import PIPE
-from subprocess import Popen
+from typing import Dict
 
 import requests
 from botocore.exceptions import ClientError
 from rich.prompt import Prompt
 
+from telemetry.telescope_devkit.cache import get_cache_key
+from telemetry.telescope_devkit.cache import load_json_cache
+from telemetry.telescope_devkit.cache import save_json_cache
 from telemetry.telescope_devkit.cli import get_console
 from telemetry.telescope_devkit.codebuild import Codebuild
-from telemetry.telescope_devkit.ec2 import Ec2
-from telemetry.telescope_devkit.grafana import Grafana
+from telemetry.telescope_devkit.grafana import RenderQuery
+from telemetry.telescope_devkit.logger import create_buffered_logger
 from telemetry.telescope_devkit.logger import create_file_logger
+from telemetry.telescope_devkit.logger import flush_buffered_logger
+from telemetry.telescope_devkit.logger import get_buffered_messages
 from telemetry.telescope_devkit.logger import get_file_logger
-from telemetry.telescope_devkit.sts import get_account_name
+from telemetry.telescope_devkit.migration.fixtures import build_fixture
+from telemetry.telescope_devkit.ssh import run_remote
 from telemetry.telescope_devkit.sts import Sts
 
+# How long a check result can be reused by `check --only_failed`
+CHECK_RESULT_TTL = 3600  # seconds
+
 
 def create_migration_checklist_logger():
     account_name = Sts().account_name
     filename = f"{account_name}-migration-checklist.log"
     file_logger = create_file_logger(name="migration", filename=filename)
-    get_console().print(
+    get_console(stderr=True).print(
         f"* Check activity is being logged to [blue]log/{account_name}-migration-checklist.log[/blue]"
     )
 
@@ -54,6 +65,19 @@ def get_percentage_diff(previous, current):
     return int(percentage)
 
 
+def get_average(datapoints: list, since: float = None) -> float or None:
+    """The average of the non-null values of Graphite [value, timestamp] datapoints."""
+    values = [
+        value
+        for value, timestamp in datapoints
+        if value is not None and (since is None or timestamp >= since)
+    ]
+    if not values:
+        return None
+
+    return sum(values) / len(values)
+
+
 class NotImplementedException(Exception):
     pass
 
@@ -65,6 +89,16 @@ class Check(object):
     _console = get_console()
     _sts = None
     _logger = None
+    _result_ttl = CHECK_RESULT_TTL
+    _checked_at = None
+    _is_cached = False
+    # Whether the result can change from one run to the next, see MigrationChecklist.watch()
+    _is_volatile = True
+    # Names of the FIXTURES this check needs, built by the checklist before the check starts
+    _fixtures = ()
+    _fixture_futures = None
+    _duration = None
+    _log_messages = ()
 
     def check(self):
         raise NotImplementedException
@@ -72,6 +106,26 @@ class Check(object):
     def check_interactively(self):
         raise NotImplementedException
 
+    def run(self) -> None:
+        """Run the check, interactively if it requires manual intervention, and time it."""
+        start = time.perf_counter()
+        try:
+            if self.requires_manual_intervention():
+                self.check_interactively()
+            else:
+                self.check()
+        finally:
+            self._duration = time.perf_counter() - start
+
+    @property
+    def duration(self) -> float or None:
+        return self._duration
+
+    @property
+    def log_messages(self) -> tuple:
+        """The log lines of the last run, when its logs were buffered."""
+        return self._log_messages
+
     @property
     def description(self) -> str:
         return self._description
@@ -82,11 +136,77 @@ class Check(object):
     def requires_manual_intervention(self) -> bool:
         return self._requires_manual_intervention
 
+    @property
+    def fixture_names(self) -> tuple:
+        return self._fixtures
+
+    def use_fixtures(self, fixtures: Dict[str, Future]) -> None:
+        self._fixture_futures = fixtures
+
+    def fixture(self, name: str):
+        """
+        The value of a fixture, or the exception raised while building it. Fixtures that the
+        checklist didn't provide are built on demand.
+        """
+        if self._fixture_futures is None or name not in self._fixture_futures:
+            return build_fixture(name, self.sts)
+        return self._fixture_futures[name].result()
+
+    def fail(self, error: Exception) -> None:
+        """Record the check as failed because it raised instead of reaching a result."""
+        self.logger.debug(error)
+        self._is_successful = False
+
+    def is_volatile(self) -> bool:
+        return self._is_volatile and not self._requires_manual_intervention
+
+    def reset(self) -> None:
+        """Forget the result of the last run before running the check again."""
+        self._is_successful = None
+        self._is_cached = False
+        self._duration = None
+        self._log_messages = ()
+
+    def is_cached(self) -> bool:
+        return self._is_cached
+
+    @property
+    def checked_at(self) -> float or None:
+        return self._checked_at
+
+    def load_result(self, account_name: str, phase: str) -> bool:
+        """Restore the result of a previous run if it passed and hasn't expired yet."""
+        result = load_json_cache(
+            "migration-checks",
+            get_cache_key(account_name, phase, self.__class__.__name__),
+        )
+        if result is None or not result["is_successful"]:
+            return False
+
+        self._is_successful = True
+        self._checked_at = result["checked_at"]
+        self._is_cached = True
+
+        return True
+
+    def save_result(self, account_name: str, phase: str) -> None:
+        self._checked_at = time.time()
+        save_json_cache(
+            "migration-checks",
+            get_cache_key(account_name, phase, self.__class__.__name__),
+            {
+                "is_successful": bool(self._is_successful),
+                "checked_at": self._checked_at,
+            },
+            self._checked_at + self._result_ttl,
+        )
+
     def launch_manual_intervention_prompt(self):
         result = Prompt.ask(
             "Please enter the result for this check",
             choices=["pass", "fail"],
             default="fail",
+            console=self._console,
         )
         self._is_successful = True if result == "pass" else False
 
@@ -96,6 +216,20 @@ class Check(object):
             self._logger = get_migration_checklist_logger()
         return self._logger
 
+    def buffer_logs(self) -> None:
+        """Hold this check's log lines in memory until flush_logs() is called, so that checks
+        running concurrently don't interleave their output in the checklist log file."""
+        self._logger = create_buffered_logger(
+            f"migration.{self.__class__.__name__}", get_migration_checklist_logger()
+        )
+
+    def flush_logs(self) -> None:
+        self._log_messages = tuple(get_buffered_messages(self.logger))
+        flush_buffered_logger(self.logger)
+
+    def use_console(self, console) -> None:
+        self._console = console
+
     @property
     def sts(self):
         if self._sts is None:
@@ -105,16 +239,17 @@ class Check(object):
 
 class TerraformBuild(Check):
     _description = "Terraform CodeBuild project is green"
+    _fixtures = ("internal_base_session",)
 
     def check(self):
         self.logger.info(f"Check: {self._description}")
         codebuild = Codebuild()
-        session = Sts().start_internal_base_engineer_role_session()
+        session = self.fixture("internal_base_session")
 
         self._is_successful = False
 
         latest_build_id = codebuild.get_latest_terraform_build_id(
-            f"build-telemetry-{get_account_name()}-terraform", session
+            f"build-telemetry-{self.sts.account_name}-terraform", session
         )
         self.logger.debug(f"Latest Terraform build identifier = {latest_build_id}")
         latest_build_status = codebuild.get_terraform_build_status(
@@ -129,12 +264,12 @@ class TerraformBuild(Check):
 
 class EcsStatusChecks(Check):
     _description = "ECS Status Checks are green"
+    _fixtures = ("ecs_instance",)
 
     def check(self):
         self.logger.info(f"Check: {self._description}")
 
-        ec2 = Ec2()
-        instance = ec2.get_instance_by_name(name="telemetry-ecs", enable_wildcard=False)
+        instance = self.fixture("ecs_instance")
         if not instance:
             self.logger.debug(
                 "There are no ECS telemetry running instances in this environment"
@@ -143,8 +278,10 @@ class EcsStatusChecks(Check):
             return
 
         # get the ecs status check result
-        cmd = f'ssh {instance.private_ip_address} curl http://ecs-status-checks.telemetry.internal:5000/test -s -o /dev/null -I -w "%{{http_code}}"'
-        completed_process = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE)
+        cmd = 'curl http://ecs-status-checks.telemetry.internal:5000/test -s -o /dev/null -I -w "%{http_code}"'
+        completed_process = run_remote(
+            instance.private_ip_address, shlex.split(cmd), stdout=subprocess.PIPE
+        )
         return_code = completed_process.stdout.decode("utf-8")
         if return_code == "200":
             self._is_successful = True
@@ -154,8 +291,10 @@ class EcsStatusChecks(Check):
         # return to the user the details ecs status check results
         self.logger.debug(f"ECS Status Checks returned status code {return_code}")
         self.logger.debug("detailed result of ecs-status-checks:")
-        cmd = f"ssh {instance.private_ip_address} curl http://ecs-status-checks.telemetry.internal:5000 -s"
-        completed_process = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE)
+        cmd = "curl http://ecs-status-checks.telemetry.internal:5000 -s"
+        completed_process = run_remote(
+            instance.private_ip_address, shlex.split(cmd), stdout=subprocess.PIPE
+        )
         try:
             response = json.loads(completed_process.stdout)
             self.logger.debug(json.dumps(response, indent=4))
@@ -165,45 +304,74 @@ class EcsStatusChecks(Check):
 
 class KafkaConsumption(Check):
     _description = "Kafka consumption looks correct"
+    _fixtures = ("nwt_grafana",)
 
     def check(self):
         self.logger.info(f"Check: {self._description}")
 
         try:
-            grafana = Grafana(
-                hostname=f"grafana.{self.sts.account_name}.telemetry.tax.service.gov.uk"
-            )
+            grafana = self.fixture("nwt_grafana")
         except ClientError as e:
             self.logger.debug(e)
             self._is_successful = False
             return
 
-        # Validate that all partitions have an offset greater than 0
-        self.logger.debug("Validate that all partitions have an offset greater than 0")
-        metric_query = "aliasByNode(telemetry.telescope.msk.logs.partition_*.offset%2C%204)&from=-5min&until=now&format=json&maxDataPoints=1"
+        msk_consumer_groups = ["logs"]
+        msk_log_retention_period = "1h"
+        partition_offset_period = 5 * 60  # seconds
+        lag_threshold = 90
+        # Both targets are rendered over the retention period so that they share one /render
+        # request, the partition offsets are then averaged over their own shorter period
+        queries = [
+            RenderQuery(
+                name="partitions",
+                target="aliasByNode(telemetry.telescope.msk.logs.partition_*.offset, 4)",
+            )
+        ]
+        for msk_consumer_group in msk_consumer_groups:
+            queries.append(
+                RenderQuery(
+                    name=msk_consumer_group,
+                    target=f"alias(offset(scale(keepLastValue(divideSeries(telemetry.telescope.msk.{msk_consumer_group}.sum-lag,telemetry.telescope.msk.{msk_consumer_group}.sum-range), 60), -100), 100), 'Offset')",
+                )
+            )
         try:
-            data = grafana.get_metric_value(metric_query=metric_query)
+            data = grafana.render(queries, from_time=f"-{msk_log_retention_period}")
         except Exception as e:
             self.logger.debug(e)
             self._is_successful = False
             return
 
-        for partition in data:
-            if int(partition["datapoints"][0][0]) < 0:
+        # Validate that all partitions have an offset greater than 0
+        self.logger.debug("Validate that all partitions have an offset greater than 0")
+        since = time.time() - partition_offset_period
+        for partition in data["partitions"]:
+            offset = get_average(partition["datapoints"], since)
+            if offset is None:
+                self.logger.debug(
+                    f"{partition['target']} has no offset in the last {partition_offset_period}s"
+                )
+                self._is_successful = False
+                return
+            if int(offset) < 0:
                 self.logger.debug(
-                    f"{partition['target']} has an offset of {partition['datapoints'][0][0]} which is an error code"
+                    f"{partition['target']} has an offset of {offset} which is an error code"
                 )
                 self._is_successful = False
                 return
 
         # Validate that all consumers are up-to-date
-        msk_consumer_groups = ["logs"]
-        msk_log_retention_period = "1h"
-        lag_threshold = 90
         for msk_consumer_group in msk_consumer_groups:
-            metric_query = f"alias(offset(scale(keepLastValue(divideSeries(telemetry.telescope.msk.{msk_consumer_group}.sum-lag%2Ctelemetry.telescope.msk.{msk_consumer_group}.sum-range)%2C%2060)%2C%20-100)%2C%20100)%2C%20'Offset')&from=-{msk_log_retention_period}&until=now&format=json&maxDataPoints=1"
-            data = grafana.get_metric_value(metric_query=metric_query)
-            currentness_percentage = round(data[0]["datapoints"][0][0], 2)
+            currentness_percentage = get_average(
+                data[msk_consumer_group][0]["datapoints"]
+            )
+            if currentness_percentage is None:
+                self.logger.debug(
+                    f"consumer group {msk_consumer_group} has no up-to-dateness in the last {msk_log_retention_period}"
+                )
+                self._is_successful = False
+                return
+            currentness_percentage = round(currentness_percentage, 2)
             if currentness_percentage < lag_threshold:
                 self.logger.debug(
                     f"consumer group {msk_consumer_group} has an up-to-dateness of {currentness_percentage}% which is less than the threshold of {lag_threshold}%"
@@ -218,13 +386,10 @@ class ElasticSearchIngest(Check):
     _description = "Data is being ingested into NWT elasticsearch effectively"
     _indexing_rate_period = "15min"
     _rate_diff_threshold = 10  # percentage difference
+    _fixtures = ("webops_grafana", "nwt_grafana", "ip_prefix")
 
     def _get_indexing_rate_from_webops(self):
-        account_name = str(self.sts.account_name).replace("mdtp-", "")
-        grafana = Grafana(
-            hostname=f"grafana.tools.{account_name}.tax.service.gov.uk",
-            ssm_path="/telemetry/secrets/grafana/webops_migration_api_key",
-        )
+        grafana = self.fixture("webops_grafana")
         metric_query = f"averageSeries(sumSeries(removeEmptySeries(perSecond(collectd.elasticsearch-data*.es-default.gauge-index.docs.count))))&from=-{self._indexing_rate_period}&until=now&format=json&maxDataPoints=1"
         data = grafana.get_metric_value(metric_query=metric_query)
         if not data:
@@ -235,17 +400,9 @@ class ElasticSearchIngest(Check):
         return round(float(data[0]["datapoints"][0][0]), 2)
 
     def _get_indexing_rate_from_tnt(self):
-        grafana = Grafana(
-            hostname="grafana.internal-telemetry.telemetry.tax.service.gov.uk",
-            ssm_path="/telemetry/secrets/grafana/tnt_migration_api_key",
-        )
+        grafana = self.fixture("tnt_grafana")
         # get environment cidr A&B
-        ec2 = Ec2()
-        instance = ec2.get_instance_by_name(
-            name="elasticsearch-query", enable_wildcard=False
-        )
-        ip_blocks = instance.private_ip_address.split(".")
-        ip_filter = f"ip-{ip_blocks[0]}-{ip_blocks[1]}-"
+        ip_filter = self.fixture("ip_prefix")
 
         metric_query = f"averageSeries(sumSeries(removeEmptySeries(perSecond(collectd.elasticsearch-data*{ip_filter}*.es-default.gauge-index.docs.count))))&from=-{self._indexing_rate_period}&until=now&format=json&maxDataPoints=1"
         data = grafana.get_metric_value(metric_query=metric_query)
@@ -257,18 +414,9 @@ class ElasticSearchIngest(Check):
         return round(float(data[0]["datapoints"][0][0]), 2)
 
     def _get_indexing_rate_from_mdtp(self):
-        account_name = str(self.sts.account_name)
-        grafana = Grafana(
-            hostname=f"grafana.{account_name}.telemetry.tax.service.gov.uk",
-            ssm_path="/telemetry/secrets/grafana/migration_api_key",
-        )
+        grafana = self.fixture("nwt_grafana")
         # get environment cidr A&B
-        ec2 = Ec2()
-        instance = ec2.get_instance_by_name(
-            name="elasticsearch-query", enable_wildcard=False
-        )
-        ip_blocks = instance.private_ip_address.split(".")
-        ip_filter = f"ip-{ip_blocks[0]}-{ip_blocks[1]}-"
+        ip_filter = self.fixture("ip_prefix")
 
         metric_query = f"averageSeries(sumSeries(removeEmptySeries(perSecond(collectd.elasticsearch-data*{ip_filter}*.es-default.gauge-index.docs.count))))&from=-{self._indexing_rate_period}&until=now&format=json&maxDataPoints=1"
         data = grafana.get_metric_value(metric_query=metric_query)
@@ -395,6 +543,7 @@ class LogsDataIsValid(Check):
 class ClickhouseMetricsChecks(Check):
     _description = "Metrics data ingested in NWT matches WebOps"
     _requires_manual_intervention = False
+    _fixtures = ("nwt_clickhouse_instance", "webops_clickhouse_instance")
 
     def check(self):
         self.logger.info(f"Check: {self._description}")
@@ -405,7 +554,7 @@ class ClickhouseMetricsChecks(Check):
         self.logger.debug(f"End Time: {end_time}")
 
         nwt_account_name = str(self.sts.account_name)
-        webops_account_name = str(self.sts.account_name).replace("mdtp-", "webops-")
+        webops_account_name = self.sts.webops_account
         clickhouse_query = (
             f'echo "SELECT COUNT(*) '
             f"FROM graphite.graphite_distributed "
@@ -415,18 +564,16 @@ class ClickhouseMetricsChecks(Check):
         )
 
         # Get metric count from NWT environment
-        nwt_ec2 = Ec2()
         nwt_metric_count = self._get_metric_ingest_count(
-            nwt_ec2, clickhouse_query, nwt_account_name
+            "nwt_clickhouse_instance", clickhouse_query, nwt_account_name
         )
         if nwt_metric_count is None:
             self._is_successful = False
             return
 
         # Get metric count from WebOps environment
-        webops_ec2 = Ec2(self.sts.start_webops_platform_deity_role_session())
         webops_metric_count = self._get_metric_ingest_count(
-            webops_ec2, clickhouse_query, webops_account_name
+            "webops_clickhouse_instance", clickhouse_query, webops_account_name
         )
         if webops_metric_count is None:
             self._is_successful = False
@@ -449,11 +596,11 @@ class ClickhouseMetricsChecks(Check):
             self._is_successful = False
             return
 
-    def _get_metric_ingest_count(self, ec2_client, clickhouse_query, environment_name):
+    def _get_metric_ingest_count(
+        self, instance_fixture, clickhouse_query, environment_name
+    ):
         try:
-            instance = ec2_client.get_instance_by_name(
-                name="clickhouse-server-shard_1", enable_wildcard=False
-            )
+            instance = self.fixture(instance_fixture)
             if not instance:
                 self.logger.debug(
                     f"There are no Clickhouse Shard 1 instances in {environment_name}"
@@ -463,10 +610,10 @@ class ClickhouseMetricsChecks(Check):
             self.logger.debug(
                 f"Getting metrics from Clickhouse in {environment_name}: {instance.private_ip_address}"
             )
-            stdout, stderr = Popen(
-                ["ssh", instance.private_ip_address, clickhouse_query], stdout=PIPE
-            ).communicate()
-            return_value = int(stdout.decode("utf-8").strip())
+            completed_process = run_remote(
+                instance.private_ip_address, clickhouse_query, stdout=PIPE
+            )
+            return_value = int(completed_process.stdout.decode("utf-8").strip())
             self.logger.debug(
                 f"Ingested metric count for {environment_name}: {return_value}"
             )
@@ -479,14 +626,17 @@ class ClickhouseMetricsChecks(Check):
 class ClickhouseSnapshotGeneration(Check):
     _description = "Clickhouse Data Volume Snapshots Taken"
     _requires_manual_intervention = False
+    # Each run takes new snapshots
+    _is_volatile = False
+    _fixtures = ("webops_ec2",)
 
     def check(self):
         self.logger.info(f"Generate: {self._description}")
-        webops_account_name = str(self.sts.account_name).replace("mdtp-", "webops-")
+        webops_account_name = self.sts.webops_account
 
         try:
             # Create snapshots in WebOps for both shards 1 & 2
-            webops_ec2 = Ec2(self.sts.start_webops_platform_deity_role_session())
+            webops_ec2 = self.fixture("webops_ec2")
             shard_1_snapshot = self._generate_snapshot(
                 webops_ec2, webops_account_name, "clickhouse-server-shard_1"
             )
@@ -544,6 +694,7 @@ class ClickhouseSnapshotGeneration(Check):
 class MetricsDataIsValid(Check):
     _description = "Metrics data in NWT is valid"
     _requires_manual_intervention = False
+    _fixtures = ("nwt_grafana", "webops_grafana")
 
     def check(self):
         self.logger.info(f"Check: {self._description}")
@@ -563,7 +714,7 @@ class MetricsDataIsValid(Check):
             self.logger.debug(f"{self.sts.account_name} datapoints: {nwt_datapoints}")
 
             webops_datapoints = self._get_metric_values_from_webops(metric_query)
-            webops_account_name = str(self.sts.account_name).replace("mdtp-", "webops-")
+            webops_account_name = self.sts.webops_account
             self.logger.debug(f"{webops_account_name} datapoints: {webops_datapoints}")
 
             if nwt_datapoints == webops_datapoints:
@@ -578,19 +729,13 @@ class MetricsDataIsValid(Check):
             return
 
     def _get_metric_values_from_nwt(self, metric_query: str):
-        grafana = Grafana(
-            hostname=f"grafana.{self.sts.account_name}.telemetry.tax.service.gov.uk"
-        )
+        grafana = self.fixture("nwt_grafana")
         data = grafana.get_metric_value(metric_query=metric_query)
 
         return data[0]["datapoints"]
 
     def _get_metric_values_from_webops(self, metric_query: str):
-        webops_account_name = str(self.sts.account_name).replace("mdtp-", "")
-        grafana = Grafana(
-            hostname=f"grafana.tools.{webops_account_name}.tax.service.gov.uk",
-            ssm_path="/telemetry/secrets/grafana/webops_migration_api_key",
-        )
+        grafana = self.fixture("webops_grafana")
         data = grafana.get_metric_value(metric_query=metric_query)
 
         return data[0]["datapoints"]
@@ -649,11 +794,12 @@ class NwtPublicWebUisRedirectFromWebops(Check):
 class WebopsEc2InstancesHaveBeenDecommissioned(Check):
     _description = "The following are no longer running in WebOps: ClickHouse, Elasticsearch-Data, Elasticsearch-Data-Warm, Elasticsearch-Query, Kibana, Grafana"
     _requires_manual_intervention = False
+    _fixtures = ("webops_ec2",)
 
     def check(self):
         self.logger.info(f"Check: {self._description}")
 
-        webops_ec2 = Ec2(self.sts.start_webops_platform_deity_role_session())
+        webops_ec2 = self.fixture("webops_ec2")
         instance_names = [
             "clickhouse-server-shard_1",
             "clickhouse-server-shard_2",
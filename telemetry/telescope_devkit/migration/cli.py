@@ -1,55 +1,237 @@
+import json
+import sys
+import time
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+
 from rich.table import Table
 
+from telemetry.telescope_devkit.ec2 import invalidate_ec2_inventories
 from telemetry.telescope_devkit.migration.checks import *
+from telemetry.telescope_devkit.migration.fixtures import Fixtures
+from telemetry.telescope_devkit.migration.phases import get_phases
+from telemetry.telescope_devkit.migration.phases import Phase
+from telemetry.telescope_devkit.profiler import profile_label
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_WATCH_INTERVAL = 60  # seconds
+CHECKLIST_OUTPUT_FORMATS = ("table", "jsonl")
 
 
 class MigrationChecklist(object):
-    _checklist = []
+    """
+    Runs the checks of one or more PHASES. A check class shared by several phases is run once
+    and its result is reported in each of them.
+    """
+
+    _phase_names = ()
     _console = get_console()
+    _output = "table"
+    _account_name = None
 
-    def __init__(self):
+    def __init__(self, phase_names=None):
+        self._phases = get_phases(phase_names or self._phase_names)
         create_migration_checklist_logger()
 
-    def _list(self, title: str) -> None:
-        table = Table(show_header=True, header_style="bold cyan")
-        table.add_column("❯  " + title, justify="left")
-        for c in self._checklist:
-            table.add_row("☐  " + c.description)
-        self._console.print(table)
+        checks = {}
+        for phase in self._phases:
+            for check_class in phase.checks:
+                if check_class not in checks:
+                    checks[check_class] = check_class()
+        self._checklist = list(checks.values())
+        self._phase_checks = {
+            phase.title: [checks[check_class] for check_class in phase.checks]
+            for phase in self._phases
+        }
 
-    def _check(self, title: str) -> int:
-        sts = Sts()
+    def list(self):
+        """Display the checks of this checklist"""
+        for phase in self._phases:
+            table = Table(show_header=True, header_style="bold cyan")
+            table.add_column("❯  " + phase.title, justify="left")
+            for c in self._phase_checks[phase.title]:
+                table.add_row("☐  " + c.description)
+            self._console.print(table)
+
+    def check(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        only_failed: bool = False,
+        output: str = "table",
+    ) -> None:
+        """Execute the checks of this checklist"""
+        # Exit rather than return the status: Fire would print it to stdout, after the JSON records
+        sys.exit(self._check(max_workers, only_failed, output))
+
+    def _check(self, max_workers: int, only_failed: bool, output: str) -> int:
+        if output not in CHECKLIST_OUTPUT_FORMATS:
+            raise ValueError(
+                f"Unknown output '{output}', expected one of: {', '.join(CHECKLIST_OUTPUT_FORMATS)}"
+            )
+        started_at = time.perf_counter()
+        self._output = output
+        self._account_name = Sts().account_name
+        if output == "jsonl":
+            # stdout only carries the JSON records, everything else goes to stderr
+            self._console = get_console(stderr=True)
+            for c in self._checklist:
+                c.use_console(self._console)
+
+        checklist = self._checklist
+        if only_failed:
+            checklist = [
+                c
+                for c in self._checklist
+                if not any(
+                    c.load_result(self._account_name, title)
+                    for title in self._get_phase_titles(c)
+                )
+            ]
+            self._console.print(
+                f"* Reusing {len(self._checklist) - len(checklist)} cached passes, "
+                f"running {len(checklist)} checks"
+            )
+            for c in self._checklist:
+                if c.is_cached():
+                    self._emit_check_record(c)
+        if max_workers > 1:
+            self._run_concurrently(checklist, max_workers)
+        else:
+            self._run_serially(checklist)
+        for c in checklist:
+            for title in self._get_phase_titles(c):
+                c.save_result(self._account_name, title)
+
+        return_code = 0
+        for phase in self._phases:
+            if self._report_phase(phase, started_at) != 0:
+                return_code = 1
+
+        return return_code
 
+    def watch(
+        self,
+        interval: int = DEFAULT_WATCH_INTERVAL,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        output: str = "table",
+    ) -> None:
+        """
+        Execute the checks, then rerun those whose result can change every --interval seconds
+        and print the checks that went from pass to fail or back. Press <ctrl-c> to stop.
+        """
+        return_code = self._check(max_workers, False, output)
+        # Sessions, clients, Grafana clients and SSH masters are kept by their registries across
+        # iterations, so reruns only repeat the calls made by the checks themselves. The EC2
+        # inventories outlive an iteration, they are taken again so replaced instances show up.
+        sts = Sts()
+        volatile = [c for c in self._checklist if c.is_volatile()]
+        self._console.print(
+            f"* Watching {len(volatile)} checks every {interval}s, "
+            f"press [yellow]<ctrl-c>[/yellow] to stop"
+        )
+        try:
+            while True:
+                time.sleep(interval)
+                previous = {c: bool(c.is_successful()) for c in volatile}
+                invalidate_ec2_inventories()
+                for c in volatile:
+                    c.reset()
+                self._rerun(volatile, max_workers, sts)
+                for c in volatile:
+                    for title in self._get_phase_titles(c):
+                        c.save_result(self._account_name, title)
+                self._report_transitions(previous)
+        except KeyboardInterrupt:
+            pass
+
+        failed = [c for c in self._checklist if not c.is_successful()]
+        sys.exit(1 if failed or return_code else 0)
+
+    def _rerun(self, checklist: list, max_workers: int, sts: Sts) -> None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fixtures = Fixtures(executor, sts)
+            futures = [
+                fixtures.submit_when_ready(c.fixture_names, self._run_buffered, c)
+                for c in checklist
+            ]
+            with self._console.status(
+                f"[bold green]Rerunning {len(checklist)} checks..."
+            ):
+                for future in as_completed(futures):
+                    pass
+
+    def _report_transitions(self, previous: dict) -> None:
+        now = datetime.datetime.now()
+        transitions = [
+            c
+            for c, was_successful in previous.items()
+            if bool(c.is_successful()) != was_successful
+        ]
+        if not transitions:
+            self._console.print(
+                f"[dim]{now:%H:%M:%S} no changes, "
+                f"{sum(1 for c in self._checklist if not c.is_successful())} failing[/dim]"
+            )
+        for c in transitions:
+            if c.is_successful():
+                self._console.print(
+                    f"{now:%H:%M:%S} [red]x[/red] → [green]✔[/green] {c.description}"
+                )
+            else:
+                self._console.print(
+                    f"{now:%H:%M:%S} [green]✔[/green] → [red]x[/red] {c.description}"
+                )
+            self._emit(
+                {
+                    "type": "transition",
+                    "id": c.__class__.__name__,
+                    "description": c.description,
+                    "from": "fail" if c.is_successful() else "pass",
+                    "to": "pass" if c.is_successful() else "fail",
+                    "phases": self._get_phase_titles(c),
+                    "account": self._account_name,
+                    "at": now.isoformat(),
+                    "details": list(c.log_messages),
+                }
+            )
+
+    def _get_phase_titles(self, c: Check) -> list:
+        return [title for title, checks in self._phase_checks.items() if c in checks]
+
+    def _report_phase(self, phase: Phase, started_at: float) -> int:
         table = Table(show_header=True, header_style="bold cyan")
         table.add_column(
-            f"  ❯   {title} ([bold]{sts.account_name}[/bold])", justify="left"
+            f"  ❯   {phase.title} ([bold]{self._account_name}[/bold])", justify="left"
         )
-        checks = {"pass": 0, "fail": 0}
-        for c in self._checklist:
-            self._console.print(f"\n[yellow]☐ Check: {c.description}[/yellow]")
-            if c.requires_manual_intervention():
-                c.check_interactively()
-            else:
-                c.check()
+
+        checks = {"pass": 0, "fail": 0, "cached": 0}
+        for c in self._phase_checks[phase.title]:
             if c.is_successful():
                 check_status = "[green]✔[/green]"
-                self._console.print(f"{check_status} Pass")
                 checks["pass"] += 1
             else:
                 check_status = "[red]x[/red]"
-                self._console.print(f"{check_status} Fail")
                 checks["fail"] += 1
-            table.add_row(f"[ {check_status} ] {c.description}")
+            if c.is_cached():
+                checks["cached"] += 1
+                age = _format_age(time.time() - c.checked_at)
+                table.add_row(
+                    f"[ {check_status} ] {c.description} [dim](cached {age} ago)[/dim]"
+                )
+            else:
+                table.add_row(f"[ {check_status} ] {c.description}")
 
         self._console.print("")
         self._console.print(table)
 
         self._console.print("\n[yellow]Status report:[/yellow]")
-        self._console.print(f"* Environment: [bold]{sts.account_name}[/bold]")
+        self._console.print(f"* Environment: [bold]{self._account_name}[/bold]")
         now = datetime.datetime.now()
         self._console.print(f"* Checklist performed on { now.ctime()}")
         self._console.print(
-            f"* Checks: {checks['pass']} successful, {checks['fail']} failed."
+            f"* Checks: {checks['pass']} successful ({checks['cached']} cached), {checks['fail']} failed."
+            if checks["cached"]
+            else f"* Checks: {checks['pass']} successful, {checks['fail']} failed."
         )
         if checks["fail"] > 0:
             self._console.print("* Outcome: [red]Environment is not healthy.[/red]\n")
@@ -58,117 +240,166 @@ class MigrationChecklist(object):
             self._console.print("* Outcome: [green]Environment is healthy.[/green]\n")
             return_code = 0
 
-        return return_code
+        self._emit(
+            {
+                "type": "summary",
+                "phase": phase.title,
+                "account": self._account_name,
+                "status": "pass" if return_code == 0 else "fail",
+                "passed": checks["pass"],
+                "failed": checks["fail"],
+                "cached": checks["cached"],
+                "duration": round(time.perf_counter() - started_at, 3),
+                "checked_at": now.isoformat(),
+            }
+        )
 
+        return return_code
 
-class Phase1Cli(MigrationChecklist):
-    def __init__(self):
-        super().__init__()
-        self._checklist = [
-            TerraformBuild(),
-            EcsStatusChecks(),
-            KafkaConsumption(),
-            ElasticSearchIngest(),
-            NwtPublicWebUis(),
-            WebopsPublicWebUis(),
-        ]
+    def _run_serially(self, checklist: list) -> None:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            fixtures = Fixtures(executor)
+            for c in checklist:
+                self._console.print(f"\n[yellow]☐ Check: {c.description}[/yellow]")
+                c.use_fixtures({n: fixtures.get(n) for n in c.fixture_names})
+                c.buffer_logs()
+                try:
+                    self._run_check(c)
+                finally:
+                    c.flush_logs()
+                self._report_check(c)
+
+    def _run_concurrently(self, checklist: list, max_workers: int) -> None:
+        """
+        Run the automated checks in a bounded thread pool while the checks requiring manual
+        intervention are prompted for one after the other on the console. The fixtures the
+        checks need are built once, in the same pool, and each check starts as soon as its own
+        fixtures are ready.
+        """
+        automated = [c for c in checklist if not c.requires_manual_intervention()]
+        manual = [c for c in checklist if c.requires_manual_intervention()]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fixtures = Fixtures(executor)
+            futures = {
+                fixtures.submit_when_ready(c.fixture_names, self._run_buffered, c): c
+                for c in automated
+            }
+
+            for c in manual:
+                self._console.print(f"\n[yellow]☐ Check: {c.description}[/yellow]")
+                self._run_check(c)
+                self._report_check(c)
+
+            with self._console.status(
+                f"[bold green]Waiting for {len(automated)} automated checks..."
+            ):
+                for future in as_completed(futures):
+                    c = futures[future]
+                    self._console.print(f"\n[yellow]☐ Check: {c.description}[/yellow]")
+                    self._report_check(c)
+
+    @classmethod
+    def _run_buffered(cls, fixtures: dict, c: Check) -> None:
+        c.use_fixtures(fixtures)
+        c.buffer_logs()
+        try:
+            cls._run_check(c)
+        finally:
+            c.flush_logs()
+
+    @staticmethod
+    def _run_check(c: Check) -> None:
+        """Run a check, recording it as failed if it raises, e.g. when one of its fixtures failed."""
+        try:
+            with profile_label(c.__class__.__name__):
+                c.run()
+        except Exception as e:
+            c.fail(e)
+
+    def _report_check(self, c: Check) -> None:
+        self._print_check_status(c)
+        self._emit_check_record(c)
+
+    def _print_check_status(self, c: Check) -> None:
+        if c.is_successful():
+            self._console.print("[green]✔[/green] Pass")
+        else:
+            self._console.print("[red]x[/red] Fail")
+
+    def _emit_check_record(self, c: Check) -> None:
+        self._emit(
+            {
+                "type": "check",
+                "id": c.__class__.__name__,
+                "description": c.description,
+                "status": "pass" if c.is_successful() else "fail",
+                "duration": round(c.duration, 3) if c.duration is not None else None,
+                "phases": self._get_phase_titles(c),
+                "account": self._account_name,
+                "cached": c.is_cached(),
+                "checked_at": datetime.datetime.fromtimestamp(
+                    c.checked_at if c.is_cached() else time.time()
+                ).isoformat(),
+                "details": list(c.log_messages),
+            }
+        )
 
-    def list(self):
-        """Display Phase 1 checks"""
-        self._list("Phase 1 checklist")
+    def _emit(self, record: dict) -> None:
+        if self._output == "jsonl":
+            sys.stdout.write(json.dumps(record) + "\n")
+            sys.stdout.flush()
 
-    def check(self) -> int:
-        """Execute Phase 1 checks"""
-        return self._check("Phase 1 checklist")
 
+def _format_age(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    if minutes:
+        return f"{minutes}m"
 
-class Phase1MetricsCli(MigrationChecklist):
-    def __init__(self):
-        super().__init__()
-        self._checklist = [
-            ClickhouseMetricsChecks(),
-        ]
+    return f"{seconds}s"
 
-    def list(self):
-        """Display Phase 1 Metrics checks"""
-        self._list("Phase 1 Metrics checklist")
 
-    def check(self) -> int:
-        """Execute Phase 1 checks"""
-        return self._check("Phase 1 Metrics checklist")
+class Phase1Cli(MigrationChecklist):
+    _phase_names = ("phase-1",)
 
 
-class Phase1SnapshotCli(MigrationChecklist):
-    def __init__(self):
-        super().__init__()
-        self._checklist = [
-            ClickhouseSnapshotGeneration(),
-        ]
+class Phase1MetricsCli(MigrationChecklist):
+    _phase_names = ("phase-1-metrics",)
 
-    def list(self):
-        """Display Phase 1 Snapshot Generation"""
-        self._list("Phase 1 Snapshot Generation")
 
-    def check(self) -> int:
-        """Execute Phase 1 Snapshot Generation"""
-        return self._check("Phase 1 Snapshot Generation")
+class Phase1SnapshotCli(MigrationChecklist):
+    _phase_names = ("phase-1-snapshot",)
 
 
 class Phase2PreCutoverCli(MigrationChecklist):
-    def __init__(self):
-        super().__init__()
-        self._checklist = [
-            TerraformBuild(),
-            EcsStatusChecks(),
-            KafkaConsumption(),
-            ElasticSearchIngest(),
-            NwtPublicWebUis(),
-            WebopsPublicWebUis(),
-            LogsDataIsValid(),
-            MetricsDataIsValid(),
-            SensuChecksAreRunningInWebops(),
-        ]
-
-    def list(self):
-        """Display Phase 2 checks"""
-        self._list("Phase 2 pre-cutover checklist")
-
-    def check(self) -> int:
-        """Execute Phase 2 checks"""
-        return self._check("Phase 2 pre-cutover checklist")
+    _phase_names = ("phase-2-pre-cutover",)
 
 
 class Phase2PostCutoverCli(MigrationChecklist):
-    def __init__(self):
-        super().__init__()
-        self._checklist = [
-            KafkaConsumption(),
-            NwtPublicWebUisRedirectFromWebops(),
-            SensuChecksAreRunningInWebops(),
-        ]
-
-    def list(self):
-        """Display Phase 2 checks"""
-        self._list("Phase 2 post-cutover checklist")
-
-    def check(self) -> int:
-        """Execute Phase 2 checks"""
-        return self._check("Phase 2 post-cutover checklist")
+    _phase_names = ("phase-2-post-cutover",)
 
 
 class Phase3Cli(MigrationChecklist):
-    def __init__(self):
-        super().__init__()
-        self._checklist = [
-            NwtPublicWebUisRedirectFromWebops(),
-            WebopsEc2InstancesHaveBeenDecommissioned(),
-            SensuChecksAreRunningInWebops(),
-        ]
-
-    def list(self):
-        """Display Phase 3 checks"""
-        self._list("Phase 3 checklist")
+    _phase_names = ("phase-3",)
+
+
+def run(
+    *phase_names,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    only_failed: bool = False,
+    output: str = "table",
+) -> None:
+    """
+    Run the checklists of several phases at once, e.g. `migration run phase-1 phase-2-pre-cutover`.
+    Checks shared by the phases run once, manual ones are asked once, and every phase gets its
+    own report.
+    """
+    if not phase_names:
+        raise ValueError(
+            "No phases given, e.g. migration run phase-1 phase-2-pre-cutover"
+        )
 
-    def check(self) -> int:
-        """Execute Phase 3 checks"""
-        return self._check("Phase 3 checklist")
+    MigrationChecklist(phase_names).check(max_workers, only_failed, output)
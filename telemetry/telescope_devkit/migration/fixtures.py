@@ -0,0 +1,163 @@
+import threading
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from typing import Callable
+from typing import Iterable
+from typing import Tuple
+
+from telemetry.telescope_devkit.ec2 import Ec2
+from telemetry.telescope_devkit.grafana import get_grafana
+from telemetry.telescope_devkit.profiler import profile_label
+from telemetry.telescope_devkit.sts import Sts
+
+
+class Fixture(object):
+    """
+    A prerequisite shared by several checks. `build` is called with the Sts of the current
+    account and the value of each fixture named in `requires`, as keyword arguments.
+    """
+
+    def __init__(self, build: Callable[..., object], requires: Tuple[str, ...] = ()):
+        self.build = build
+        self.requires = requires
+
+
+def get_ip_prefix(instance) -> str:
+    """The hostname prefix, e.g. ip-10-7-, of hosts in the same /16 as the instance."""
+    ip_blocks = instance.private_ip_address.split(".")
+    return f"ip-{ip_blocks[0]}-{ip_blocks[1]}-"
+
+
+FIXTURES = {
+    "internal_base_session": Fixture(
+        lambda sts: sts.start_internal_base_engineer_role_session()
+    ),
+    "webops_session": Fixture(
+        lambda sts: sts.start_webops_platform_deity_role_session()
+    ),
+    "webops_ec2": Fixture(
+        lambda sts, webops_session: Ec2(webops_session), requires=("webops_session",)
+    ),
+    "nwt_grafana": Fixture(
+        lambda sts: get_grafana(
+            hostname=f"grafana.{sts.account_name}.telemetry.tax.service.gov.uk"
+        )
+    ),
+    "webops_grafana": Fixture(
+        lambda sts: get_grafana(
+            hostname=f"grafana.tools.{sts.webops_account_name}.tax.service.gov.uk",
+            ssm_path="/telemetry/secrets/grafana/webops_migration_api_key",
+        )
+    ),
+    "tnt_grafana": Fixture(
+        lambda sts: get_grafana(
+            hostname="grafana.internal-telemetry.telemetry.tax.service.gov.uk",
+            ssm_path="/telemetry/secrets/grafana/tnt_migration_api_key",
+        )
+    ),
+    "ecs_instance": Fixture(
+        lambda sts: Ec2().get_instance_by_name("telemetry-ecs", enable_wildcard=False)
+    ),
+    "elasticsearch_query_instance": Fixture(
+        lambda sts: Ec2().get_instance_by_name(
+            "elasticsearch-query", enable_wildcard=False
+        )
+    ),
+    "nwt_clickhouse_instance": Fixture(
+        lambda sts: Ec2().get_instance_by_name(
+            "clickhouse-server-shard_1", enable_wildcard=False
+        )
+    ),
+    "webops_clickhouse_instance": Fixture(
+        lambda sts, webops_ec2: webops_ec2.get_instance_by_name(
+            "clickhouse-server-shard_1", enable_wildcard=False
+        ),
+        requires=("webops_ec2",),
+    ),
+    "ip_prefix": Fixture(
+        lambda sts, elasticsearch_query_instance: get_ip_prefix(
+            elasticsearch_query_instance
+        ),
+        requires=("elasticsearch_query_instance",),
+    ),
+}
+
+
+def build_fixture(name: str, sts: Sts):
+    """Build a fixture and the ones it requires one after the other, in the calling thread."""
+    fixture = FIXTURES[name]
+    return fixture.build(sts, **{n: build_fixture(n, sts) for n in fixture.requires})
+
+
+class Fixtures(object):
+    """
+    Builds the fixtures of a checklist run on an executor, each one at most once and as soon as
+    the fixtures it requires are ready, so that independent fixtures are built in parallel.
+    """
+
+    def __init__(self, executor: Executor, sts: Sts = None):
+        self._executor = executor
+        self._sts = sts or Sts()
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Future:
+        with self._lock:
+            if name in self._futures:
+                return self._futures[name]
+            future = self._futures[name] = Future()
+
+        fixture = FIXTURES[name]
+        requires = {n: self.get(n) for n in fixture.requires}
+
+        def build():
+            try:
+                kwargs = {n: f.result() for n, f in requires.items()}
+                with profile_label(f"fixture {name}"):
+                    future.set_result(fixture.build(self._sts, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        _when_all(requires.values(), lambda: self._executor.submit(build))
+
+        return future
+
+    def submit_when_ready(
+        self, names: Iterable[str], fn: Callable[..., object], *args
+    ) -> Future:
+        """
+        Call fn(fixtures, *args) on the executor once every named fixture has been built or has
+        failed, where fixtures maps each name to its (done) future.
+        """
+        fixtures = {name: self.get(name) for name in names}
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(fn(fixtures, *args))
+            except Exception as e:
+                future.set_exception(e)
+
+        _when_all(fixtures.values(), lambda: self._executor.submit(run))
+
+        return future
+
+
+def _when_all(futures: Iterable[Future], callback: Callable[[], object]) -> None:
+    futures = list(futures)
+    if not futures:
+        callback()
+        return
+
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            is_last = remaining[0] == 0
+        if is_last:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
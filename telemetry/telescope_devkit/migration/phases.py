@@ -0,0 +1,77 @@
+from typing import List
+from typing import Type
+
+from telemetry.telescope_devkit.migration.checks import *
+
+
+class Phase(object):
+    def __init__(self, title: str, checks: List[Type[Check]]):
+        self.title = title
+        self.checks = checks
+
+
+PHASES = {
+    "phase-1": Phase(
+        "Phase 1 checklist",
+        [
+            TerraformBuild,
+            EcsStatusChecks,
+            KafkaConsumption,
+            ElasticSearchIngest,
+            NwtPublicWebUis,
+            WebopsPublicWebUis,
+        ],
+    ),
+    "phase-1-metrics": Phase(
+        "Phase 1 Metrics checklist",
+        [
+            ClickhouseMetricsChecks,
+        ],
+    ),
+    "phase-1-snapshot": Phase(
+        "Phase 1 Snapshot Generation",
+        [
+            ClickhouseSnapshotGeneration,
+        ],
+    ),
+    "phase-2-pre-cutover": Phase(
+        "Phase 2 pre-cutover checklist",
+        [
+            TerraformBuild,
+            EcsStatusChecks,
+            KafkaConsumption,
+            ElasticSearchIngest,
+            NwtPublicWebUis,
+            WebopsPublicWebUis,
+            LogsDataIsValid,
+            MetricsDataIsValid,
+            SensuChecksAreRunningInWebops,
+        ],
+    ),
+    "phase-2-post-cutover": Phase(
+        "Phase 2 post-cutover checklist",
+        [
+            KafkaConsumption,
+            NwtPublicWebUisRedirectFromWebops,
+            SensuChecksAreRunningInWebops,
+        ],
+    ),
+    "phase-3": Phase(
+        "Phase 3 checklist",
+        [
+            NwtPublicWebUisRedirectFromWebops,
+            WebopsEc2InstancesHaveBeenDecommissioned,
+            SensuChecksAreRunningInWebops,
+        ],
+    ),
+}
+
+
+def get_phases(names) -> List[Phase]:
+    unknown = [name for name in names if name not in PHASES]
+    if unknown:
+        raise ValueError(
+            f"Unknown phases: {', '.join(unknown)}, expected any of: {', '.join(PHASES)}"
+        )
+
+    return [PHASES[name] for name in names]
@@ -1,51 +1,161 @@
-import boto3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
+from boto3.session import Session
+from rich.table import Table
+
+from telemetry.telescope_devkit.accounts import DEFAULT_PROFILE_TEMPLATE
+from telemetry.telescope_devkit.accounts import FAN_OUT_MAX_WORKERS
+from telemetry.telescope_devkit.accounts import print_fan_out
+from telemetry.telescope_devkit.aws import get_client
 from telemetry.telescope_devkit.cli import get_console
+from telemetry.telescope_devkit.cli import parse_time
+from telemetry.telescope_devkit.cli import print_rows
+
+CLUSTER_COLUMNS = {
+    "cluster_name": "Cluster Name",
+    "state": "State",
+    "kafka_version": "Kafka Version",
+    "broker_count": "Brokers",
+    "instance_type": "Instance Type",
+}
+BROKER_COLUMNS = {
+    "broker_id": "Broker Id",
+    "endpoints": "Endpoints",
+    "client_subnet": "Client Subnet",
+    "instance_type": "Instance Type",
+}
+BOOTSTRAP_SERVER_COLUMNS = {"type": "Type", "servers": "Bootstrap Servers"}
+CONFIGURATION_COLUMNS = {"property": "Property", "value": "Value"}
+CLUSTER_MAX_WORKERS = 4
+BROKER_METRICS = {
+    "BytesInPerSec": "Bytes In/s",
+    "BytesOutPerSec": "Bytes Out/s",
+    "CpuUser": "CPU User %",
+    "KafkaDataLogsDiskUsed": "Disk Used %",
+    "UnderReplicatedPartitions": "Under Replicated",
+}
+# Per-topic metrics are only published with the PER_TOPIC_PER_BROKER monitoring level
+TOPIC_METRICS = {
+    "BytesInPerSec": "Bytes In/s",
+    "BytesOutPerSec": "Bytes Out/s",
+    "MessagesInPerSec": "Messages In/s",
+}
+# GetMetricData accepts at most 500 queries per request
+METRIC_DATA_MAX_QUERIES = 500
+METRIC_DATA_MAX_POINTS = 60
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+
+# (broker id, topic or None, metric name)
+MetricKey = Tuple[int, Optional[str], str]
 
 
 class Msk(object):
-    def __init__(self):
-        self._client = boto3.client("kafka")
+    def __init__(self, session: Session = None, cluster_name: str = None):
+        self._session = session
+        self._cluster_name = cluster_name
+        self._clusters = None
+        self._clusters_lock = threading.Lock()
 
     @property
-    def default_cluster_arn(self):
-        return self._client.list_clusters()["ClusterInfoList"][0]["ClusterArn"]
+    def _client(self):
+        return get_client("kafka", self._session)
 
-    def get_cluster_info(self):
-        return self._client.describe_cluster(ClusterArn=self.default_cluster_arn)[
-            "ClusterInfo"
-        ]
+    @property
+    def clusters(self) -> Dict[str, str]:
+        """Cluster ARNs by cluster name, discovered once for the life of this object."""
+        with self._clusters_lock:
+            if self._clusters is None:
+                paginator = self._client.get_paginator("list_clusters_v2")
+                self._clusters = {
+                    cluster["ClusterName"]: cluster["ClusterArn"]
+                    for page in paginator.paginate()
+                    for cluster in page["ClusterInfoList"]
+                }
 
-    def get_brokers(self):
-        brokers = {}
-        response = self._client.list_nodes(
-            ClusterArn=self.default_cluster_arn, MaxResults=100
-        )
-        for broker in response["NodeInfoList"]:
-            broker_id = broker["BrokerNodeInfo"]["BrokerId"]
-            brokers[broker_id] = broker
-
-        while "NextToken" in response:
-            response = self._client.list_nodes(
-                ClusterArn=self.default_cluster_arn,
-                MaxResults=100,
-                NextToken=response["NextToken"],
+            return self._clusters
+
+    @property
+    def default_cluster_arn(self) -> str:
+        return self.get_cluster_arn(self._cluster_name)
+
+    def get_cluster_arn(self, cluster_name: str = None) -> str:
+        """The ARN of the named cluster, or of the first one in the account."""
+        if not self.clusters:
+            raise ValueError("No MSK clusters found in this account")
+        if cluster_name is None:
+            return next(iter(self.clusters.values()))
+        if cluster_name not in self.clusters:
+            raise ValueError(
+                f"Unknown MSK cluster '{cluster_name}', "
+                f"expected one of: {', '.join(self.clusters)}"
             )
-            for broker in response["NodeInfoList"]:
-                broker_id = broker["BrokerNodeInfo"]["BrokerId"]
-                brokers[broker_id] = broker
+
+        return self.clusters[cluster_name]
+
+    def get_cluster_info(self, cluster_arn: str = None):
+        return self._client.describe_cluster(
+            ClusterArn=cluster_arn or self.default_cluster_arn
+        )["ClusterInfo"]
+
+    def get_cluster_row(self) -> dict:
+        cluster_info = self.get_cluster_info()
+        return {
+            "cluster_name": cluster_info["ClusterName"],
+            "state": cluster_info["State"],
+            "kafka_version": cluster_info["CurrentBrokerSoftwareInfo"]["KafkaVersion"],
+            "broker_count": cluster_info["NumberOfBrokerNodes"],
+            "instance_type": cluster_info["BrokerNodeGroupInfo"]["InstanceType"],
+        }
+
+    def get_brokers(self, cluster_arn: str = None):
+        paginator = self._client.get_paginator("list_nodes")
+        brokers = {
+            broker["BrokerNodeInfo"]["BrokerId"]: broker
+            for page in paginator.paginate(
+                ClusterArn=cluster_arn or self.default_cluster_arn,
+                PaginationConfig={"PageSize": 100},
+            )
+            for broker in page["NodeInfoList"]
+        }
 
         return dict(sorted(brokers.items()))
 
-    def get_bootstrap_servers(self):
+    def get_broker_rows(self, cluster_arn: str = None) -> List[dict]:
+        return [
+            {
+                "broker_id": int(broker_id),
+                "endpoints": ", ".join(broker["BrokerNodeInfo"].get("Endpoints", [])),
+                "client_subnet": broker["BrokerNodeInfo"].get("ClientSubnet"),
+                "instance_type": broker.get("InstanceType"),
+            }
+            for broker_id, broker in self.get_brokers(cluster_arn).items()
+        ]
+
+    def get_bootstrap_servers(self, cluster_arn: str = None):
         response = self._client.get_bootstrap_brokers(
-            ClusterArn=self.default_cluster_arn
+            ClusterArn=cluster_arn or self.default_cluster_arn
         )
         del response["ResponseMetadata"]
         return response
 
-    def get_current_configuration(self):
-        cluster_info = self.get_cluster_info()
+    def get_bootstrap_server_rows(self, cluster_arn: str = None) -> List[dict]:
+        return [
+            {"type": broker_string_type, "servers": servers}
+            for broker_string_type, servers in self.get_bootstrap_servers(
+                cluster_arn
+            ).items()
+        ]
+
+    def get_current_configuration(self, cluster_arn: str = None):
+        cluster_info = self.get_cluster_info(cluster_arn)
         configuration_arn = cluster_info["CurrentBrokerSoftwareInfo"][
             "ConfigurationArn"
         ]
@@ -64,24 +174,316 @@ class Msk(object):
         response["ServerProperties"] = server_properties
         return response
 
+    def get_configuration_rows(self, cluster_arn: str = None) -> List[dict]:
+        server_properties = self.get_current_configuration(cluster_arn)[
+            "ServerProperties"
+        ]
+        return [
+            {"property": k.strip(), "value": v} for k, v in server_properties.items()
+        ]
+
+    def get_broker_metrics(
+        self,
+        start_time: int,
+        end_time: int,
+        statistic: str = "Average",
+        period: int = None,
+        topics: bool = False,
+        cluster_name: str = None,
+    ) -> Dict[MetricKey, List[float]]:
+        """
+        Fetch the values of BROKER_METRICS for every broker, and of TOPIC_METRICS for every topic
+        on every broker when topics is set, between two epoch millisecond times. All queries are
+        sent in as few GetMetricData requests as possible.
+        """
+        cluster_name = cluster_name or self._cluster_name or next(iter(self.clusters))
+        broker_ids = [
+            int(broker_id)
+            for broker_id in self.get_brokers(self.get_cluster_arn(cluster_name))
+        ]
+        if period is None:
+            period = get_metric_period(start_time, end_time)
+
+        metrics = {
+            (broker_id, None, metric_name): [
+                {"Name": "Cluster Name", "Value": cluster_name},
+                {"Name": "Broker ID", "Value": str(broker_id)},
+            ]
+            for broker_id in broker_ids
+            for metric_name in BROKER_METRICS
+        }
+        if topics:
+            metrics.update(self._get_topic_metrics(cluster_name))
+
+        return get_metric_data(
+            get_client("cloudwatch", self._session),
+            metrics,
+            start_time,
+            end_time,
+            statistic,
+            period,
+        )
+
+    def _get_topic_metrics(self, cluster_name: str) -> Dict[MetricKey, List[dict]]:
+        cloudwatch = get_client("cloudwatch", self._session)
+        paginator = cloudwatch.get_paginator("list_metrics")
+        metrics = {}
+        for metric_name in TOPIC_METRICS:
+            for page in paginator.paginate(
+                Namespace="AWS/Kafka",
+                MetricName=metric_name,
+                Dimensions=[{"Name": "Cluster Name", "Value": cluster_name}],
+            ):
+                for metric in page["Metrics"]:
+                    dimensions = {d["Name"]: d["Value"] for d in metric["Dimensions"]}
+                    if "Topic" in dimensions and "Broker ID" in dimensions:
+                        key = (
+                            int(dimensions["Broker ID"]),
+                            dimensions["Topic"],
+                            metric_name,
+                        )
+                        metrics[key] = metric["Dimensions"]
+
+        return metrics
+
+    def get_rows_of_all_clusters(
+        self,
+        fn: Callable[[str], List[dict]],
+        max_workers: int = CLUSTER_MAX_WORKERS,
+    ) -> List[dict]:
+        """
+        Call fn with the ARN of every cluster concurrently and return the rows of all of them,
+        in cluster name order and with a "cluster" key added.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                cluster_name: executor.submit(fn, cluster_arn)
+                for cluster_name, cluster_arn in sorted(self.clusters.items())
+            }
+
+        return [
+            {"cluster": cluster_name, **row}
+            for cluster_name, future in futures.items()
+            for row in future.result()
+        ]
+
+
+def get_metric_period(start_time: int, end_time: int) -> int:
+    """The smallest whole number of minutes that fits the window in METRIC_DATA_MAX_POINTS."""
+    window = (end_time - start_time) / 1000
+    return max(1, -(-int(window) // (60 * METRIC_DATA_MAX_POINTS))) * 60
+
+
+def get_metric_data(
+    cloudwatch_client,
+    metrics: Dict[MetricKey, List[dict]],
+    start_time: int,
+    end_time: int,
+    statistic: str,
+    period: int,
+) -> Dict[MetricKey, List[float]]:
+    """
+    Fetch the AWS/Kafka metrics with the given dimensions, METRIC_DATA_MAX_QUERIES at a time.
+    Returns the values of each metric in ascending time order.
+    """
+    keys = list(metrics)
+    values = {key: [] for key in keys}
+    paginator = cloudwatch_client.get_paginator("get_metric_data")
+    for offset in range(0, len(keys), METRIC_DATA_MAX_QUERIES):
+        batch = keys[offset : offset + METRIC_DATA_MAX_QUERIES]
+        queries = [
+            {
+                "Id": f"m{offset + i}",
+                "MetricStat": {
+                    "Metric": {
+                        "Namespace": "AWS/Kafka",
+                        "MetricName": key[2],
+                        "Dimensions": metrics[key],
+                    },
+                    "Period": period,
+                    "Stat": statistic,
+                },
+            }
+            for i, key in enumerate(batch)
+        ]
+        for page in paginator.paginate(
+            MetricDataQueries=queries,
+            StartTime=datetime.fromtimestamp(start_time / 1000, tz=timezone.utc),
+            EndTime=datetime.fromtimestamp(end_time / 1000, tz=timezone.utc),
+            ScanBy="TimestampAscending",
+        ):
+            for result in page["MetricDataResults"]:
+                values[keys[int(result["Id"][1:])]].extend(result["Values"])
+
+    return values
+
+
+def get_sparkline(values: List[float]) -> str:
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    scale = (len(SPARKLINE_BLOCKS) - 1) / (high - low) if high > low else 0
+
+    return "".join(SPARKLINE_BLOCKS[int((v - low) * scale)] for v in values)
+
+
+def _format_metric_value(metric_name: str, value: float) -> str:
+    if metric_name.startswith("Bytes"):
+        for unit in ("B", "KiB", "MiB", "GiB"):
+            if abs(value) < 1024:
+                break
+            value /= 1024
+        return f"{value:.1f} {unit}"
+
+    return f"{value:.1f}" if value % 1 else f"{value:.0f}"
+
 
 class MskCli(object):
     def __init__(self):
         self._console = get_console()
         self._msk = Msk()
 
-    def cluster(self):
-        """Describes the MSK cluster"""
-        self._console.print(self._msk.get_cluster_info())
+    def cluster(
+        self,
+        accounts=None,
+        all_accounts: bool = False,
+        output: str = "table",
+        profile_template: str = DEFAULT_PROFILE_TEMPLATE,
+        max_workers: int = FAN_OUT_MAX_WORKERS,
+        cluster_name: str = None,
+    ):
+        """
+        Describes the MSK cluster, or the one named with --cluster_name. With --accounts=mdtp-qa,mdtp-staging or --all_accounts a
+        summary of the cluster in every selected account is displayed instead.
+        """
+        if accounts or all_accounts:
+            print_fan_out(
+                lambda session: [Msk(session).get_cluster_row()],
+                CLUSTER_COLUMNS,
+                accounts,
+                all_accounts,
+                output,
+                profile_template,
+                max_workers,
+            )
+            return
 
-    def bootstrap_servers(self):
+        self._console.print(
+            self._msk.get_cluster_info(self._msk.get_cluster_arn(cluster_name))
+        )
+
+    def bootstrap_servers(
+        self,
+        cluster_name: str = None,
+        all_clusters: bool = False,
+        output: str = "table",
+    ):
         """Displays a list of brokers that a client application can use to bootstrap."""
-        self._console.print(self._msk.get_bootstrap_servers())
+        if all_clusters:
+            return self._print_all_clusters(
+                self._msk.get_bootstrap_server_rows, BOOTSTRAP_SERVER_COLUMNS, output
+            )
 
-    def brokers(self):
+        self._console.print(
+            self._msk.get_bootstrap_servers(self._msk.get_cluster_arn(cluster_name))
+        )
+
+    def brokers(
+        self,
+        cluster_name: str = None,
+        all_clusters: bool = False,
+        output: str = "table",
+    ):
         """Returns a list of the broker nodes in the cluster."""
-        self._console.print(self._msk.get_brokers())
+        if all_clusters:
+            return self._print_all_clusters(
+                self._msk.get_broker_rows, BROKER_COLUMNS, output
+            )
 
-    def configuration(self):
+        self._console.print(
+            self._msk.get_brokers(self._msk.get_cluster_arn(cluster_name))
+        )
+
+    def configuration(
+        self,
+        cluster_name: str = None,
+        all_clusters: bool = False,
+        output: str = "table",
+    ):
         """Displays the current cluster configuration"""
-        self._console.print(self._msk.get_current_configuration())
+        if all_clusters:
+            return self._print_all_clusters(
+                self._msk.get_configuration_rows, CONFIGURATION_COLUMNS, output
+            )
+
+        self._console.print(
+            self._msk.get_current_configuration(self._msk.get_cluster_arn(cluster_name))
+        )
+
+    def metrics(
+        self,
+        cluster_name: str = None,
+        since: str = "1h",
+        until: str = None,
+        statistic: str = "Average",
+        period: int = None,
+        topics: bool = False,
+    ):
+        """
+        Displays a broker by metric matrix of the cluster's CloudWatch metrics, with the latest
+        value and a sparkline of the window, e.g. --since=6h --statistic=Maximum. Use --topics
+        to add per-topic metrics, which requires PER_TOPIC_PER_BROKER enhanced monitoring.
+        """
+        start_time = parse_time(since)
+        end_time = parse_time(until) if until is not None else parse_time("0s")
+        with self._console.status("[bold green]Fetching MSK metrics...") as status:
+            values = self._msk.get_broker_metrics(
+                start_time, end_time, statistic, period, topics, cluster_name
+            )
+
+        self._print_metrics_matrix(
+            "Broker", values, BROKER_METRICS, lambda topic: topic is None
+        )
+        if topics:
+            self._print_metrics_matrix(
+                "Broker / Topic", values, TOPIC_METRICS, lambda topic: topic is not None
+            )
+
+    def _print_metrics_matrix(
+        self,
+        title: str,
+        values: Dict[MetricKey, List[float]],
+        columns: dict,
+        include: Callable[[Optional[str]], bool],
+    ) -> None:
+        table = Table(show_header=True, header_style="bold green")
+        table.add_column(title)
+        for header in columns.values():
+            table.add_column(header, justify="right")
+
+        rows = sorted(
+            {(broker_id, topic) for broker_id, topic, _ in values if include(topic)},
+            key=lambda row: (row[0], row[1] or ""),
+        )
+        for broker_id, topic in rows:
+            cells = []
+            for metric_name in columns:
+                series = values.get((broker_id, topic, metric_name), [])
+                cells.append(
+                    f"{_format_metric_value(metric_name, series[-1])} {get_sparkline(series)}"
+                    if series
+                    else "-"
+                )
+            label = f"{broker_id} / {topic}" if topic is not None else str(broker_id)
+            table.add_row(label, *cells)
+        self._console.print(table)
+
+    def _print_all_clusters(
+        self, fn: Callable[[str], List[dict]], columns: dict, output: str
+    ) -> None:
+        with get_console(stderr=True).status(
+            "[bold green]Querying all MSK clusters..."
+        ) as status:
+            rows = self._msk.get_rows_of_all_clusters(fn)
+
+        print_rows(self._console, rows, {"cluster": "Cluster", **columns}, output)
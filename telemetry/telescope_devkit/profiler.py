@@ -0,0 +1,236 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+from urllib.parse import urlsplit
+
+# Enabled by the global --profile flag of bin/telescope.py, see enable_profiling()
+_profiler = None
+_context = threading.local()
+
+WATERFALL_WIDTH = 40
+
+
+class Span(object):
+    def __init__(
+        self,
+        service: str,
+        name: str,
+        start: float,
+        end: float,
+        label: str = None,
+        error: str = None,
+    ):
+        self.service = service
+        self.name = name
+        self.start = start
+        self.end = end
+        self.label = label
+        self.error = error
+        self.thread_id = threading.get_ident()
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Profiler(object):
+    """
+    Records the AWS API calls, HTTP requests and subprocesses made while a command runs, tagged
+    with the check (or other label set with profile_label()) of the thread that made them.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @property
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return sorted(self._spans, key=lambda span: span.start)
+
+    def record(
+        self, service: str, name: str, start: float, end: float, error: str = None
+    ) -> None:
+        span = Span(service, name, start, end, get_profile_label(), error)
+        with self._lock:
+            self._spans.append(span)
+
+    def instrument_client(self, client) -> None:
+        """Time every API call of a botocore client, retries included."""
+
+        def before_call(model, context, **kwargs):
+            context["telescope_profile"] = (
+                model.service_model.service_name,
+                model.name,
+                time.perf_counter(),
+            )
+
+        # after-call-error is only given the exception and the context
+        def after_call(context, exception=None, parsed=None, **kwargs):
+            if "telescope_profile" in context:
+                service, name, start = context.pop("telescope_profile")
+                if exception is not None:
+                    error = type(exception).__name__
+                else:
+                    error = (parsed or {}).get("Error", {}).get("Code")
+                self.record(service, name, start, time.perf_counter(), error)
+
+        client.meta.events.register("before-call.*.*", before_call)
+        client.meta.events.register("after-call.*.*", after_call)
+        client.meta.events.register("after-call-error.*.*", after_call)
+
+    def print_waterfall(self, console) -> None:
+        from rich.markup import escape
+        from rich.table import Table
+
+        spans = self.spans
+        if not spans:
+            console.print("[yellow]No calls were recorded.[/yellow]")
+            return
+        total = max(max(span.end for span in spans) - self.started_at, 1e-6)
+
+        table = Table(show_header=True, header_style="bold cyan", title="Waterfall")
+        table.add_column("Start", justify="right")
+        table.add_column("Duration", justify="right")
+        for column in ("Service", "Call", "Check", ""):
+            table.add_column(column)
+        for span in spans:
+            offset = int((span.start - self.started_at) / total * WATERFALL_WIDTH)
+            length = max(1, int(span.duration / total * WATERFALL_WIDTH))
+            bar_colour = "red" if span.error else "green"
+            table.add_row(
+                f"{(span.start - self.started_at) * 1000:.0f} ms",
+                f"{span.duration * 1000:.0f} ms",
+                span.service,
+                escape(span.name) + (f" [red]{span.error}[/red]" if span.error else ""),
+                span.label or "",
+                " " * offset + f"[{bar_colour}]{'█' * length}[/{bar_colour}]",
+            )
+        console.print(table)
+
+        totals = {}
+        for span in spans:
+            totals.setdefault(span.service, []).append(span.duration)
+        table = Table(
+            show_header=True, header_style="bold cyan", title="Totals per service"
+        )
+        for column in ("Service", "Calls", "Total", "Max"):
+            table.add_column(column, justify="left" if column == "Service" else "right")
+        for service, durations in sorted(
+            totals.items(), key=lambda item: sum(item[1]), reverse=True
+        ):
+            table.add_row(
+                service,
+                str(len(durations)),
+                f"{sum(durations) * 1000:.0f} ms",
+                f"{max(durations) * 1000:.0f} ms",
+            )
+        console.print(table)
+
+    def write_chrome_trace(self, filename: str) -> None:
+        """Write the spans in the Chrome trace event format, see chrome://tracing or Perfetto."""
+        events = [
+            {
+                "name": f"{span.service} {span.name}",
+                "cat": span.service,
+                "ph": "X",
+                "ts": int((span.start - self.started_at) * 1e6),
+                "dur": int(span.duration * 1e6),
+                "pid": os.getpid(),
+                "tid": span.thread_id,
+                "args": {"check": span.label, "error": span.error},
+            }
+            for span in self.spans
+        ]
+        with open(filename, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+class _ProfiledPopen(subprocess.Popen):
+    def __init__(self, args, *posargs, **kwargs):
+        self._profile_start = time.perf_counter()
+        self._profile_recorded = False
+        command = args if isinstance(args, str) else " ".join(str(a) for a in args)
+        self._profile_service = os.path.basename(command.split(" ", 1)[0])
+        self._profile_name = command
+        super().__init__(args, *posargs, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if not self._profile_recorded and _profiler is not None:
+            self._profile_recorded = True
+            _profiler.record(
+                self._profile_service,
+                self._profile_name,
+                self._profile_start,
+                time.perf_counter(),
+                f"exit {returncode}" if returncode else None,
+            )
+        return returncode
+
+
+def _instrument_requests(profiler: Profiler) -> None:
+    import requests
+
+    request = requests.Session.request
+
+    def profiled_request(session, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        error = None
+        try:
+            response = request(session, method, url, *args, **kwargs)
+            if response.status_code >= 400:
+                error = str(response.status_code)
+            return response
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            parts = urlsplit(url)
+            profiler.record(
+                parts.hostname or "http",
+                f"{method.upper()} {parts.path or '/'}",
+                start,
+                time.perf_counter(),
+                error,
+            )
+
+    requests.Session.request = profiled_request
+
+
+def enable_profiling() -> Profiler:
+    """
+    Start recording calls for the rest of the process. AWS clients are instrumented as they are
+    created by telemetry.telescope_devkit.aws, while requests and subprocesses are patched here.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+        _instrument_requests(_profiler)
+        subprocess.Popen = _ProfiledPopen
+
+    return _profiler
+
+
+def get_profiler() -> Profiler or None:
+    return _profiler
+
+
+def get_profile_label() -> str or None:
+    return getattr(_context, "label", None)
+
+
+@contextmanager
+def profile_label(label: str):
+    """Tag the calls made by the current thread, e.g. with the name of the running check."""
+    previous = get_profile_label()
+    _context.label = label
+    try:
+        yield
+    finally:
+        _context.label = previous
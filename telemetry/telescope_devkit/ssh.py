@@ -1,10 +1,188 @@
+import atexit
+import os
 import shlex
+import shutil
 import socket
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Union
+
+from rich.table import Table
 
 from telemetry.telescope_devkit.cli import get_console
 
+# Masters left behind by a process that didn't exit cleanly shut down after this idle time
+SSH_CONTROL_PERSIST = "10m"
+TUNNEL_READY_TIMEOUT = 30  # seconds
+# Remote commands given a timeout run under coreutils' timeout, which sends SIGKILL this long
+# after SIGTERM and exits with one of these codes when the command timed out. The command can
+# exit with them too, e.g. when killed with SIGKILL, so they only count once the timeout passed.
+REMOTE_TIMEOUT_KILL_AFTER = 5  # seconds
+REMOTE_TIMEOUT_EXIT_CODES = (124, 137)
+
+
+class SshConnectionManager(object):
+    """
+    Opens one SSH ControlMaster per target host, with control sockets kept in a private
+    directory, and hands out ssh arguments that multiplex over it. Remote commands and port
+    forwards then skip the SSH handshake (and bastion hops) after the first connection to a
+    host. Hosts whose master can't be started fall back to plain ssh connections.
+    """
+
+    def __init__(self):
+        self._control_dir = None
+        self._masters = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    @property
+    def control_dir(self) -> str:
+        if self._control_dir is None:
+            self._control_dir = tempfile.mkdtemp(prefix="telescope-ssh-")
+
+        return self._control_dir
+
+    @property
+    def control_path(self) -> str:
+        return os.path.join(self.control_dir, "%C")
+
+    def get_options(self, host: str) -> List[str]:
+        """Return the ssh options that reuse the master for this host, starting it if needed."""
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+
+        with host_lock:
+            if host not in self._masters:
+                self._masters[host] = self._start_master(host)
+
+            if not self._masters[host]:
+                return []
+
+        return ["-o", f"ControlPath={self.control_path}", "-o", "ControlMaster=no"]
+
+    def command(self, host: str, *args: str) -> List[str]:
+        return ["ssh", *self.get_options(host), host, *args]
+
+    def has_master(self, host: str) -> bool:
+        return self._masters.get(host, False)
+
+    def close_all(self) -> None:
+        for host, is_running in self._masters.items():
+            if is_running:
+                subprocess.run(
+                    [
+                        "ssh",
+                        "-o",
+                        f"ControlPath={self.control_path}",
+                        "-O",
+                        "exit",
+                        host,
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+        self._masters = {}
+
+        if self._control_dir is not None:
+            shutil.rmtree(self._control_dir, ignore_errors=True)
+            self._control_dir = None
+
+    def _start_master(self, host: str) -> bool:
+        cmd = [
+            "ssh",
+            "-M",
+            "-N",
+            "-f",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            f"ControlPersist={SSH_CONTROL_PERSIST}",
+            host,
+        ]
+        return subprocess.run(cmd).returncode == 0
+
+
+_ssh_connection_manager = None
+_ssh_connection_manager_lock = threading.Lock()
+
+
+def get_ssh_connection_manager() -> SshConnectionManager:
+    global _ssh_connection_manager
+    with _ssh_connection_manager_lock:
+        if _ssh_connection_manager is None:
+            _ssh_connection_manager = SshConnectionManager()
+            atexit.register(_ssh_connection_manager.close_all)
+
+        return _ssh_connection_manager
+
+
+def run_remote(
+    host: str, command: Union[str, List[str]], **kwargs
+) -> subprocess.CompletedProcess:
+    """Run a command on a remote host over its shared SSH connection."""
+    args = [command] if isinstance(command, str) else command
+
+    return subprocess.run(get_ssh_connection_manager().command(host, *args), **kwargs)
+
+
+def stream_remote(
+    host: str, command: str, on_line: Callable[[str], None], timeout: float = None
+) -> int:
+    """
+    Run a command on a remote host over its shared SSH connection, passing each line of its
+    combined stdout and stderr to on_line as it arrives. Raises subprocess.TimeoutExpired
+    after killing the command if it runs for longer than the timeout in seconds.
+    """
+    if timeout:
+        # Killing the local ssh client would leave the command running on the remote host, so
+        # the remote host enforces the timeout. The local timer only catches a hung connection.
+        command = (
+            f"timeout --kill-after={REMOTE_TIMEOUT_KILL_AFTER} {timeout} "
+            f"sh -c {shlex.quote(command)}"
+        )
+    cmd = get_ssh_connection_manager().command(host, command)
+    started_at = time.monotonic()
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    timed_out = threading.Event()
+
+    def kill() -> None:
+        timed_out.set()
+        process.kill()
+
+    timer = (
+        threading.Timer(timeout + 2 * REMOTE_TIMEOUT_KILL_AFTER, kill)
+        if timeout
+        else None
+    )
+    if timer:
+        timer.start()
+    try:
+        for line in process.stdout:
+            on_line(line)
+        returncode = process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+
+    if timed_out.is_set() or (
+        timeout
+        and returncode in REMOTE_TIMEOUT_EXIT_CODES
+        and time.monotonic() - started_at >= timeout
+    ):
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    return returncode
+
 
 class LocalPortForwarding(object):
     def __init__(
@@ -21,16 +199,58 @@ class LocalPortForwarding(object):
         self.local_host = local_host
         self.local_port = destination_port if local_port is None else local_port
         self._console = get_console()
+        self._ssh = get_ssh_connection_manager()
+
+    @property
+    def forward_spec(self) -> str:
+        return f"{self.local_host}:{self.local_port}:{self.destination_host}:{self.destination_port}"
 
     def start(self) -> int:
-        cmd = f"ssh -L {self.local_host}:{self.local_port}:{self.destination_host}:{self.destination_port} -f -N {self.ssh_server}"
-        self._console.print(f"[cyan]EXEC: {cmd}[/cyan]")
-        return subprocess.run(shlex.split(cmd)).returncode
+        options = self._ssh.get_options(self.ssh_server)
+        if self._ssh.has_master(self.ssh_server):
+            cmd = ["ssh", *options, "-O", "forward", "-L", self.forward_spec]
+        else:
+            cmd = ["ssh", "-L", self.forward_spec, "-f", "-N"]
+        cmd.append(self.ssh_server)
+        self._console.print(f"[cyan]EXEC: {shlex.join(cmd)}[/cyan]")
+        return subprocess.run(cmd).returncode
 
     def stop(self) -> int:
-        cmd = f"ssh -O cancel -L {self.local_host}:{self.local_port}:{self.destination_host}:{self.destination_port} {self.ssh_server}"
-        self._console.print(f"[cyan]EXEC: {cmd}[/cyan]")
-        return subprocess.run(shlex.split(cmd)).returncode
+        cmd = [
+            "ssh",
+            *self._ssh.get_options(self.ssh_server),
+            "-O",
+            "cancel",
+            "-L",
+            self.forward_spec,
+            self.ssh_server,
+        ]
+        self._console.print(f"[cyan]EXEC: {shlex.join(cmd)}[/cyan]")
+        return subprocess.run(cmd).returncode
+
+    def wait_until_reachable(
+        self,
+        deadline: float = TUNNEL_READY_TIMEOUT,
+        initial_delay: float = 0.1,
+        max_delay: float = 2,
+    ) -> Union[float, None]:
+        """
+        Probe the local end of the forward with exponential backoff until it accepts
+        connections or the deadline, in seconds, passes. Returns how long the forward took to
+        become reachable, or None if it never did.
+        """
+        started_at = time.monotonic()
+        delay = initial_delay
+        while True:
+            if self.is_service_reachable():
+                return time.monotonic() - started_at
+
+            remaining = started_at + deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
 
     def is_service_reachable(self) -> bool:
         try:
@@ -41,6 +261,106 @@ class LocalPortForwarding(object):
             return False
 
 
+class TunnelSession(object):
+    """
+    Several local port forwards through the same SSH server, all set up over the server's
+    single multiplexed connection and probed for readiness concurrently.
+    """
+
+    def __init__(
+        self,
+        ssh_server: str,
+        forwards: List[Tuple[str, int, int]],
+        local_host: str = "0.0.0.0",
+    ):
+        self.ssh_server = ssh_server
+        self.forwards = [
+            LocalPortForwarding(
+                ssh_server,
+                destination_host=host,
+                destination_port=port,
+                local_host=local_host,
+                local_port=local_port,
+            )
+            for host, port, local_port in forwards
+        ]
+
+    def start(
+        self, deadline: float = TUNNEL_READY_TIMEOUT
+    ) -> Dict[LocalPortForwarding, Union[float, None]]:
+        """Start every forward and return the seconds each took to become reachable."""
+        for forward in self.forwards:
+            forward.start()
+
+        with ThreadPoolExecutor(max_workers=len(self.forwards)) as executor:
+            ready_times = executor.map(
+                lambda forward: forward.wait_until_reachable(deadline), self.forwards
+            )
+
+            return dict(zip(self.forwards, ready_times))
+
+    def stop(self) -> None:
+        for forward in self.forwards:
+            forward.stop()
+
+
+def start_tunnel_session(
+    console, session: TunnelSession, deadline: float = TUNNEL_READY_TIMEOUT
+) -> bool:
+    """
+    Start a tunnel session and report how long each forward took to become usable. If any
+    forward is unreachable by the deadline the whole session is stopped.
+    """
+    with console.status(
+        f"[bold green]Setting up {len(session.forwards)} SSH port forwards via {session.ssh_server}... "
+    ) as status:
+        ready_times = session.start(deadline)
+
+    table = Table(show_header=True, header_style="bold green")
+    table.add_column("Local Address")
+    table.add_column("Remote Service")
+    table.add_column("Ready In")
+    for forward, ready_time in ready_times.items():
+        table.add_row(
+            f"{forward.local_host}:{forward.local_port}",
+            f"{forward.destination_host}:{forward.destination_port}",
+            f"{ready_time:.2f}s"
+            if ready_time is not None
+            else "[red]unreachable[/red]",
+        )
+    console.print(table)
+
+    if None in ready_times.values():
+        console.print("Unable to reach every remote service, stopping the SSH tunnel")
+        session.stop()
+        return False
+
+    return True
+
+
+def parse_forwards(forwards) -> List[Tuple[str, int, int]]:
+    """
+    Parse forwards given as "host:port" or "local_port:host:port", either comma separated in a
+    single string or as a list, into (host, port, local_port) tuples.
+    """
+    if isinstance(forwards, str):
+        forwards = forwards.split(",")
+
+    parsed = []
+    for forward in forwards or []:
+        parts = str(forward).strip().split(":")
+        if len(parts) == 2:
+            parsed.append((parts[0], int(parts[1]), int(parts[1])))
+        elif len(parts) == 3:
+            parsed.append((parts[1], int(parts[2]), int(parts[0])))
+        else:
+            raise ValueError(
+                f"Invalid forward '{forward}', expected host:port or local_port:host:port"
+            )
+
+    return parsed
+
+
 def ssh_to(ip_address: str) -> int:
-    completed_process = subprocess.run(["ssh", ip_address])
+    completed_process = subprocess.run(get_ssh_connection_manager().command(ip_address))
     return completed_process.returncode
@@ -1,24 +1,41 @@
-import json
-import os
+import threading
+import time
 
-import boto3
 from boto3.session import Session
 
 from telemetry.telescope_devkit import APP_NAME
-from telemetry.telescope_devkit.filesystem import get_repo_path
+from telemetry.telescope_devkit.accounts import DEFAULT_PROFILE_TEMPLATE
+from telemetry.telescope_devkit.accounts import FAN_OUT_MAX_WORKERS
+from telemetry.telescope_devkit.accounts import get_aws_accounts
+from telemetry.telescope_devkit.accounts import print_fan_out
+from telemetry.telescope_devkit.aws import get_client
+from telemetry.telescope_devkit.aws import get_session
+from telemetry.telescope_devkit.cache import get_cache_key
+from telemetry.telescope_devkit.cache import is_disk_cache_enabled
+from telemetry.telescope_devkit.cache import load_json_cache
+from telemetry.telescope_devkit.cache import save_json_cache
+from telemetry.telescope_devkit.cli import get_console
+
+# How long a cached caller identity is reused when the credentials carry no expiry time
+CALLER_IDENTITY_CACHE_TTL = 3600  # seconds
+
+_caller_identities = {}
+_caller_identities_lock = threading.Lock()
+_caller_identity_locks = {}
 
 
 class Sts(object):
-    def __init__(self):
-        try:
-            self._sts = boto3.client("sts")
-        except ValueError as e:
-            raise Exception(f"{e}\nAre you running {APP_NAME} in an AWS profile?")
+    def __init__(self, session: Session = None):
+        self._session = session
         self.aws_accounts = load_aws_accounts()
 
+    @property
+    def caller_identity(self) -> dict:
+        return get_caller_identity(self._session)
+
     @property
     def account(self) -> str:
-        return self._sts.get_caller_identity()["Account"]
+        return self.caller_identity["Account"]
 
     @property
     def account_name(self) -> str:
@@ -26,19 +43,24 @@ class Sts(object):
 
     @property
     def arn(self) -> str:
-        return self._sts.get_caller_identity()["Arn"]
+        return self.caller_identity["Arn"]
 
     @property
     def user_id(self) -> str:
-        return self._sts.get_caller_identity()["UserId"]
+        return self.caller_identity["UserId"]
 
     @property
     def is_mdtp_account(self) -> bool:
-        return self.aws_accounts[self.account].startswith("mdtp-")
+        return self.account_name.startswith("mdtp-")
 
     @property
     def is_webops_account(self) -> bool:
-        return self.aws_accounts[self.account].startswith("webops-")
+        return self.account_name.startswith("webops-")
+
+    @property
+    def webops_account(self) -> str or None:
+        """The webops-X account paired with the current mdtp-X account."""
+        return get_aws_accounts().get_webops_pair(self.account_name)
 
     @property
     def webops_account_name(self) -> str or None:
@@ -51,19 +73,61 @@ class Sts(object):
     def start_webops_platform_deity_role_session(self) -> Session:
         profile = f"webops-{self.webops_account_name}-RoleInterimPlatformDeity"
 
-        return Session(profile_name=profile)
+        return get_session(profile)
 
     @staticmethod
     def start_internal_base_engineer_role_session() -> Session:
         profile = f"telemetry-internal-base-RoleTelemetryEngineer"
 
-        return Session(profile_name=profile)
+        return get_session(profile)
 
 
 def load_aws_accounts() -> dict:
-    with open(os.path.join(get_repo_path(), "data/aws-accounts.json")) as json_file:
-        data = json.load(json_file)
-        return {v: k for k, v in data.items()}
+    return get_aws_accounts().names
+
+
+def get_caller_identity(session: Session = None) -> dict:
+    """
+    Resolve the caller identity once per set of credentials and share it with every caller in
+    this process. When TELESCOPE_DEVKIT_DISK_CACHE is enabled the identity is also kept on disk,
+    keyed by access key and expiry time, so that subsequent runs skip the STS call altogether.
+    """
+    session = session or get_session()
+    credentials = session.get_credentials()
+    if credentials is None:
+        raise Exception(
+            f"Unable to locate AWS credentials.\nAre you running {APP_NAME} in an AWS profile?"
+        )
+    access_key = credentials.access_key
+    expiry_time = getattr(credentials, "_expiry_time", None)
+
+    # Identities of different credentials are resolved concurrently, each behind its own lock
+    with _caller_identities_lock:
+        caller_identity_lock = _caller_identity_locks.setdefault(
+            access_key, threading.Lock()
+        )
+    with caller_identity_lock:
+        if access_key in _caller_identities:
+            return _caller_identities[access_key]
+
+        cache_key = get_cache_key(access_key, expiry_time)
+        identity = (
+            load_json_cache("sts", cache_key) if is_disk_cache_enabled() else None
+        )
+        if identity is None:
+            response = get_client("sts", session).get_caller_identity()
+            identity = {k: response[k] for k in ("Account", "Arn", "UserId")}
+            if is_disk_cache_enabled():
+                expires_at = (
+                    expiry_time.timestamp()
+                    if expiry_time is not None
+                    else time.time() + CALLER_IDENTITY_CACHE_TTL
+                )
+                save_json_cache("sts", cache_key, identity, expires_at)
+
+        _caller_identities[access_key] = identity
+
+        return identity
 
 
 def get_account_name() -> str:
@@ -71,11 +135,36 @@ def get_account_name() -> str:
 
 
 class StsCli(object):
-    def __init__(self, session=boto3.session.Session()):
+    def __init__(self, session: Session = None):
         self._console = get_console()
-        self._sts = Sts(session.client("sts"))
+        self._sts = Sts(session)
+
+    def get_caller_identity(
+        self,
+        accounts=None,
+        all_accounts: bool = False,
+        output: str = "table",
+        profile_template: str = DEFAULT_PROFILE_TEMPLATE,
+        max_workers: int = FAN_OUT_MAX_WORKERS,
+    ):
+        """
+        Display the account and ARN the current credentials belong to, or those of the AWS
+        profile of every account selected with --accounts=mdtp-qa,mdtp-staging or --all_accounts
+        """
+        if accounts or all_accounts:
+            print_fan_out(
+                lambda session: [
+                    {"account_id": Sts(session).account, "arn": Sts(session).arn}
+                ],
+                {"account_id": "Account Id", "arn": "ARN"},
+                accounts,
+                all_accounts,
+                output,
+                profile_template,
+                max_workers,
+            )
+            return
 
-    def get_caller_identity(self) -> None:
         with self._console.status("[bold green]Getting caller identity...") as status:
             self._console.print(
                 f"Currently running in {self._sts.account} as {self._sts.arn}"
@@ -0,0 +1,48 @@
+import logging
+import threading
+import time
+
+from telemetry.telescope_devkit.logger import create_buffered_logger
+from telemetry.telescope_devkit.logger import flush_buffered_logger
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+        # Give other flushing threads a chance to run, as a write to the log file would
+        time.sleep(0.001)
+
+
+def test_buffers_flushed_concurrently_stay_grouped():
+    target = logging.getLogger("test-buffered-target")
+    target.setLevel(logging.DEBUG)
+    target.propagate = False
+    handler = ListHandler()
+    target.addHandler(handler)
+
+    loggers = [create_buffered_logger(f"test-buffered-{i}", target) for i in range(4)]
+    for i, logger in enumerate(loggers):
+        for line in range(50):
+            logger.info(f"{i}:{line}")
+
+    barrier = threading.Barrier(len(loggers))
+
+    def flush(logger: logging.Logger) -> None:
+        barrier.wait()
+        flush_buffered_logger(logger)
+
+    threads = [threading.Thread(target=flush, args=(l,)) for l in loggers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    target.removeHandler(handler)
+
+    groups = [message.split(":")[0] for message in handler.messages]
+    switches = sum(1 for a, b in zip(groups, groups[1:]) if a != b)
+    assert len(groups) == 200
+    assert switches == len(loggers) - 1
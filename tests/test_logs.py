@@ -0,0 +1,62 @@
+import os
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from telemetry.telescope_devkit import logs
+from telemetry.telescope_devkit.logs import follow_cloudwatch_log_group
+from telemetry.telescope_devkit.logs import LogTailState
+
+GROUP_NAME = "/aws/codebuild/build-telemetry-terraform"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("TELESCOPE_DEVKIT_CACHE_DIR", str(tmp_path))
+
+
+@pytest.fixture
+def logs_client():
+    session = boto3.session.Session(
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        region_name="eu-west-2",
+    )
+    return session.client("logs")
+
+
+def test_tail_starts_at_the_creation_of_a_stream_without_events(logs_client):
+    state = LogTailState(GROUP_NAME)
+    with Stubber(logs_client) as stubber:
+        stubber.add_response(
+            "describe_log_streams",
+            {"logStreams": [{"logStreamName": "empty", "creationTime": 1000}]},
+        )
+        log_stream = state.start_at_latest_stream(logs_client)
+
+    assert log_stream["logStreamName"] == "empty"
+    assert state.timestamp == 1000
+    assert state.event_ids == []
+
+
+def test_follow_keeps_its_position_when_a_stream_has_no_events(
+    logs_client, monkeypatch
+):
+    def interrupt(seconds):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(logs.time, "sleep", interrupt)
+    state = LogTailState(GROUP_NAME)
+    state.timestamp = 1000
+    with Stubber(logs_client) as stubber:
+        stubber.add_response(
+            "filter_log_events",
+            {"events": []},
+            {"logGroupName": GROUP_NAME, "startTime": 1000},
+        )
+        follow_cloudwatch_log_group(logs_client, GROUP_NAME, state)
+        stubber.assert_no_pending_responses()
+
+    assert state.timestamp == 1000
+    assert not os.path.isfile(state.filename)
@@ -0,0 +1,78 @@
+import logging
+
+import pytest
+
+from telemetry.telescope_devkit.migration import checks
+from telemetry.telescope_devkit.migration import cli
+from telemetry.telescope_devkit.migration import fixtures
+from telemetry.telescope_devkit.migration import phases
+from telemetry.telescope_devkit.migration.checks import Check
+from telemetry.telescope_devkit.migration.cli import MigrationChecklist
+from telemetry.telescope_devkit.migration.fixtures import Fixture
+from telemetry.telescope_devkit.migration.phases import Phase
+
+
+class FakeSts(object):
+    account_name = "test-account"
+
+
+def build_broken_fixture(sts):
+    raise RuntimeError("Unable to build the fixture")
+
+
+class UsesWorkingFixture(Check):
+    _description = "Uses a fixture that builds"
+    _fixtures = ("working",)
+
+    def check(self):
+        self._is_successful = self.fixture("working") == "value"
+
+
+class UsesBrokenFixture(Check):
+    _description = "Uses a fixture that raises"
+    _fixtures = ("broken",)
+
+    def check(self):
+        self.fixture("broken")
+        self._is_successful = True
+
+
+class UsesNoFixture(Check):
+    _description = "Uses no fixture"
+
+    def check(self):
+        self._is_successful = True
+
+
+@pytest.fixture(autouse=True)
+def environment(tmp_path, monkeypatch):
+    monkeypatch.setenv("TELESCOPE_DEVKIT_CACHE_DIR", str(tmp_path))
+    for module in (checks, cli, fixtures):
+        monkeypatch.setattr(module, "Sts", FakeSts)
+    monkeypatch.setattr(
+        cli,
+        "create_migration_checklist_logger",
+        lambda: logging.getLogger("migration"),
+    )
+    monkeypatch.setitem(fixtures.FIXTURES, "working", Fixture(lambda sts: "value"))
+    monkeypatch.setitem(fixtures.FIXTURES, "broken", Fixture(build_broken_fixture))
+    monkeypatch.setitem(
+        phases.PHASES,
+        "test",
+        Phase("Test checklist", [UsesWorkingFixture, UsesBrokenFixture, UsesNoFixture]),
+    )
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_a_broken_fixture_only_fails_the_checks_that_use_it(max_workers):
+    checklist = MigrationChecklist(["test"])
+
+    return_code = checklist._check(max_workers, False, "table")
+
+    results = {type(c): c.is_successful() for c in checklist._checklist}
+    assert results == {
+        UsesWorkingFixture: True,
+        UsesBrokenFixture: False,
+        UsesNoFixture: True,
+    }
+    assert return_code == 1